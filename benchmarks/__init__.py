@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks
+Benchmarks for the wscontest-votecounter scripts.
+
+This package is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+Run the benchmarks from the root of the repository, e.g.:
+    python -m benchmarks.decoder
+    python -m benchmarks.suite
+
+benchmarks.synthetic generates synthetic contests, so that the benchmarks do
+not send requests to Wikisource.
+"""
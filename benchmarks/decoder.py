@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/decoder.py
+Microbenchmarks of the per-revision cost of decoding and scoring in score.py.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+usage: python -m benchmarks.decoder [-h] [-n NUM_REVISIONS] [-r REPEAT]
+
+Measure the per-revision cost of decoding and scoring revisions.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  -n NUM_REVISIONS      Number of revisions (default: 10000)
+  -r REPEAT             Number of repetitions, the best one is reported
+                        (default: 5)
+
+The "legacy" benchmarks reproduce the code used by get_score() before the
+decoding stage was introduced: datetime.strptime() and an uncompiled
+re.findall() on the whole text for every revision, and debug messages
+formatted even when debug logging is disabled. Before the benchmarks, the
+points of score_pages() are checked against the if/elif chain of get_score(),
+with the transitions evaluated both with and without NumPy.
+"""
+
+import re
+import random
+import calendar
+import logging
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+import score
+import scoring
+from scoring import SAL
+
+### GLOBALS AND DEFAULTS ###
+NUM_REVISIONS = 10000
+REPEAT = 5
+# size (in characters) of the text of every revision
+TEXT_SIZE = 2000
+### ###
+
+
+def make_page(num_revisions, seed=0):
+    """Return a page with num_revisions in the format returned by the API."""
+    rnd = random.Random(seed)
+    timestamp = datetime(2017, 11, 1)
+    revisions = []
+    for revid in range(1, num_revisions + 1):
+        user = 'User{}'.format(rnd.randint(0, 99))
+        level = rnd.randint(0, 4)
+        text = ('<noinclude><pagequality level="{level}" user="{user}" />'
+                '</noinclude>'.format(level=level, user=user))
+        text += 'x' * (TEXT_SIZE - len(text))
+        revisions.append({'revid': revid,
+                          'user': user,
+                          'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                          '*': text
+                          })
+        timestamp += timedelta(minutes=rnd.randint(1, 600))
+
+    # the API returns the newest revision first
+    return {'query': {'pages': {'1': {'title': 'Page:Book.djvu/1',
+                                      'revisions': revisions[::-1]}}}}
+
+
+def legacy_decode_revisions(data):
+    revs = list(data['query']['pages'].values())[0]['revisions'][::-1]
+
+    revisions = []
+    for rev in revs:
+        timestamp = datetime.strptime(rev['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
+        user = rev['user']
+        txt = rev['*']
+        quality_level, newUser = re.findall('<pagequality level="(\\d)" user="(.*?)" />', txt)[0]
+        revisions.append((rev['revid'], timestamp, user, int(quality_level)))
+
+    return revisions
+
+
+def legacy_score_page(revisions, contest_start, contest_end, scores):
+    """Add to scores the points of revisions, with the if/elif chain of the
+    legacy get_score() (debug output left out)."""
+    punts, vali, revi, revi2, revi3, revi5 = scores
+
+    old = None
+    oldUser = None
+    oldTimestamp = None
+    for revid, timestamp, newUser, quality_level in revisions:
+        if quality_level == SAL[50] and (old is None or old < SAL[50]) \
+                and timestamp >= contest_start \
+                and timestamp < contest_end:
+            punts[newUser] += 2
+            revi[newUser] += 1
+            revi2[newUser] += 1
+
+        elif quality_level == SAL[75] and (old is None or old < SAL[75]) \
+                and timestamp >= contest_start \
+                and timestamp < contest_end:
+            if old == SAL[50]:
+                punts[newUser] += 3
+                revi[newUser] += 1
+                revi3[newUser] += 1
+            elif (old is None or old <= SAL[25]):
+                punts[newUser] += 5
+                revi[newUser] += 1
+                revi5[newUser] += 1
+
+        elif quality_level == SAL[100] and old == SAL[75] \
+                and timestamp >= contest_start \
+                and timestamp < contest_end:
+            punts[newUser] += 1
+            vali[newUser] += 1
+
+        elif quality_level == SAL[75] and old == SAL[100] \
+                and timestamp >= contest_start:
+            if oldTimestamp >= contest_start and oldTimestamp <= contest_end:
+                punts[oldUser] -= 1
+                vali[oldUser] -= 1
+
+        elif quality_level < SAL[75] and old == SAL[75] \
+                and timestamp >= contest_start:
+            if oldTimestamp >= contest_start and oldTimestamp <= contest_end:
+                if quality_level == SAL[50]:
+                    punts[oldUser] -= 3
+                    revi[oldUser] -= 1
+                    revi3[newUser] -= 1
+                else:
+                    punts[oldUser] -= 5
+                    revi[oldUser] -= 1
+                    revi5[newUser] -= 1
+
+        elif quality_level < SAL[50] and old == SAL[50] \
+                and timestamp >= contest_start:
+            if oldTimestamp >= contest_start and oldTimestamp <= contest_end:
+                punts[oldUser] -= 2
+                revi[oldUser] -= 1
+                revi2[newUser] -= 1
+
+        old = quality_level
+        oldUser = newUser
+        oldTimestamp = timestamp
+
+
+def check_score_pages(pages, contest_start, contest_end):
+    """Check that score_pages() assigns the points of the legacy chain, with
+    all the cases, in a single batch (NumPy) and page by page (pure Python,
+    pages are shorter than NUMPY_MIN_BATCH)."""
+    legacy = score.empty_scores()
+    for pag, revs, state in pages:
+        legacy_score_page(revs, contest_start, contest_end, legacy)
+
+    revisions = [rev for pag, revs, state in pages for rev in revs]
+    assert len(revisions) >= scoring.NUMPY_MIN_BATCH
+    assert all(len(revs) < scoring.NUMPY_MIN_BATCH for _, revs, _ in pages)
+
+    events = scoring.score_transitions(
+        [scoring.NO_QUALITY] + [rev.quality for rev in revisions[:-1]],
+        [rev.quality for rev in revisions],
+        [0] + [rev.timestamp for rev in revisions[:-1]],
+        [rev.timestamp for rev in revisions],
+        contest_start, contest_end)
+    assert set(case for _, case in events) == \
+        set(range(len(scoring.CASES))) - {scoring.CASE_NONE}
+
+    batch, _, _ = score.score_pages('Book.djvu', pages,
+                                    contest_start, contest_end)
+    assert batch == legacy
+
+    by_page = score.empty_scores()
+    for pag, revs, state in pages:
+        page_scores, _ = score.score_page('Book.djvu', pag, revs,
+                                          contest_start, contest_end, state)
+        for totals, values in zip(by_page, page_scores):
+            for user, value in values.items():
+                totals[user] += value
+    assert by_page == legacy
+
+
+def legacy_log_revisions(revisions):
+    old = None
+    oldUser = None
+    for pag, (revid, timestamp, user, quality_level) in enumerate(revisions):
+        score.logger.debug("Revision(page={page},user={user},"
+                           "quality={quality},old_user={old_user},"
+                           "old_quality={old_quality},"
+                           "timestamp={timestamp})"
+            .format(page=pag, user=user, quality=quality_level,
+                    old_user=oldUser, old_quality=old,
+                    timestamp=timestamp))
+        old = quality_level
+        oldUser = user
+
+
+def log_revisions(revisions):
+    log_debug = score.logger.isEnabledFor(logging.DEBUG)
+
+    old = None
+    oldUser = None
+    for pag, (revid, timestamp, user, quality_level) in enumerate(revisions):
+        if log_debug:
+            score.logger.debug("Revision(page={page},user={user},"
+                               "quality={quality},old_user={old_user},"
+                               "old_quality={old_quality},"
+                               "timestamp={timestamp})"
+                .format(page=pag, user=user, quality=quality_level,
+                        old_user=oldUser, old_quality=old,
+                        timestamp=score.format_timestamp(timestamp)))
+        old = quality_level
+        oldUser = user
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def run(num_revisions, repeat):
+    data = make_page(num_revisions)
+    revisions = score.decode_revisions(data)
+
+    legacy = [(revid, calendar.timegm(timestamp.timetuple()), user, quality)
+              for revid, timestamp, user, quality
+              in legacy_decode_revisions(data)]
+    assert legacy == [tuple(rev) for rev in revisions]
+
+    contest_start = revisions[len(revisions) // 4].timestamp
+    contest_end = revisions[3 * len(revisions) // 4].timestamp
+    # the same revisions, as a book of pages with 10 revisions each
+    pages = [(pag, revisions[i:i + 10], None)
+             for pag, i in enumerate(range(0, len(revisions), 10), 1)]
+    check_score_pages(pages, contest_start, contest_end)
+
+    benchmarks = [
+        ('decode (legacy)', lambda: legacy_decode_revisions(data)),
+        ('decode', lambda: score.decode_revisions(data)),
+        ('debug logging disabled (legacy)',
+         lambda: legacy_log_revisions(revisions)),
+        ('debug logging disabled', lambda: log_revisions(revisions)),
+        ('score_page', lambda: score.score_page('Book.djvu', 1, revisions,
+                                                contest_start, contest_end)),
+        ('score_pages', lambda: score.score_pages('Book.djvu', pages,
+                                                  contest_start, contest_end)),
+        ]
+
+    results = []
+    for name, func in benchmarks:
+        elapsed = best_time(func, repeat)
+        results.append((name, elapsed / num_revisions * 1e9))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    DESCRIPTION = 'Measure the per-revision cost of decoding and scoring revisions.'
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('-n', type=int, default=NUM_REVISIONS, metavar='NUM_REVISIONS',
+                        help='Number of revisions (default: {})'.format(NUM_REVISIONS))
+    parser.add_argument('-r', type=int, default=REPEAT, metavar='REPEAT',
+                        help='Number of repetitions, the best one is reported (default: {})'.format(REPEAT))
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    score.logger.setLevel(logging.WARNING)
+
+    for name, ns_per_revision in run(args.n, args.r):
+        print('{:<35} {:>10.0f} ns/revision'.format(name, ns_per_revision))
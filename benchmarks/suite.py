@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/suite.py
+Benchmarks of score.py and merge.py on synthetic contests.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+usage: python -m benchmarks.suite [-h] [--compare REPORT] [--keep]
+                                  [--max-pages N] [--max-revisions N]
+                                  [--min-pages N] [--mix UP,SKIP,REVERT,EDIT]
+                                  [-o REPORT] [-r REPEAT] [-s SCALES]
+                                  [--seed SEED] [--users N] [--workers N]
+
+Time score.py and merge.py on synthetic contests of different sizes.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --compare REPORT      Compare the timings with a previous report
+  --keep                Keep the files of the synthetic contests
+  --max-pages N         Maximum number of pages of a book (default: 50)
+  --max-revisions N     Maximum number of revisions of a page (default: 5)
+  --min-pages N         Minimum number of pages of a book (default: 5)
+  --mix UP,SKIP,REVERT,EDIT
+                        Weights of the quality transitions (default: 4,2,1,1)
+  -o REPORT             JSON file to write the report (default:
+                        benchmarks.report.json)
+  -r REPEAT             Number of repetitions, the best one is reported
+                        (default: 3)
+  -s SCALES             Comma-separated numbers of books (default:
+                        10,100,1000)
+  --seed SEED           Seed of the synthetic contests (default: 0)
+  --users N             Number of users (default: 100)
+  --workers N           Number of worker processes of get_score (default: 1)
+
+For every scale a contest is generated in a temporary directory, with all its
+pages in the cache, then get_books(), get_score(), get_rows() and write_csv()
+of score.py and get_ranking() and write_html() of merge.py are timed.
+fetch_batch_revisions() is timed on batches of a single page of the first
+FETCH_BOOKS books, served by a local server that answers as the API, and the
+requests it sends are counted (one for every page).
+The report records the timings with the parameters of the contests, the
+commit of the repository and the version of Python, so that reports of
+different commits can be compared with --compare.
+"""
+
+import os
+import sys
+import time
+import shutil
+import codecs
+import logging
+import platform
+import tempfile
+import argparse
+import threading
+import subprocess
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Try to use yajl, a faster module for JSON
+# import json
+try:
+    import yajl as json
+except ImportError:
+    import json
+
+import score
+import merge
+import scoring
+import metrics
+from benchmarks import synthetic
+
+
+### GLOBALS AND DEFAULTS ###
+SCALES = [10, 100, 1000]
+REPEAT = 3
+REPORT_FILE = 'benchmarks.report.json'
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'index.template.html')
+# number of result files merged by merge.py, as from count_votes.sh
+NUM_RESULTS = 4
+# number of books whose pages are requested to the local API server
+FETCH_BOOKS = 10
+### ###
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(TEMPLATE_FILE),
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def best_time(func, repeat):
+    """Run func repeat times, return (best time, result of the last run)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    return min(times), result
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    """Answer the queries of revisions as the API does: the history of the
+    page for a single title, the last revision of every page for more titles.
+
+    The pages are in server.pages, title -> API response of the page.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # the keep-alive connections would wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        params = urllib.parse.parse_qs(self.rfile.read(length).decode('ascii'))
+        titles = params['titles'][0].split('|')
+
+        pages = dict()
+        for i, title in enumerate(titles):
+            data = self.server.pages.get(title)
+            if data is None:
+                pages[str(-1 - i)] = {'title': title, 'missing': ''}
+                continue
+
+            pageid, page_data = list(data['query']['pages'].items())[0]
+            if 'missing' in page_data:
+                pageid = str(-1 - i)
+            elif len(titles) > 1:
+                page_data = dict(page_data,
+                                 revisions=page_data['revisions'][:1])
+            pages[pageid] = page_data
+
+        content = json.dumps({'query': {'pages': pages}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def time_fetch(books, repeat):
+    """Time fetch_batch_revisions() on batches of a single page of books.
+
+    Returns (best time, number of requests of a run).
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), APIHandler)
+    server.pages = dict()
+    batches = []
+    for book, _, pages in books:
+        for page, data in enumerate(pages, 1):
+            title = 'Page:{book}/{page}'.format(book=book, page=page)
+            server.pages[title] = data
+            batches.append((book, [page]))
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    wikisource_api = score.WIKISOURCE_API
+    score.WIKISOURCE_API = 'http://127.0.0.1:{port}/w/api.php'.format(
+        port=server.server_address[1])
+    try:
+        def fetch():
+            requests = metrics.snapshot()['counters'].get('requests', 0)
+            for book, pages in batches:
+                score.fetch_batch_revisions(book, pages, synthetic.LANG)
+            return metrics.snapshot()['counters']['requests'] - requests
+
+        elapsed, requests = best_time(fetch, repeat)
+    finally:
+        score.WIKISOURCE_API = wikisource_api
+        server.shutdown()
+        server.server_close()
+
+    # a batch of a single page is a single request
+    assert requests == len(batches)
+
+    return elapsed, requests
+
+
+def run_scale(num_books, directory, params, repeat, workers):
+    books = synthetic.make_books(num_books,
+                                 min_pages=params['min_pages'],
+                                 max_pages=params['max_pages'],
+                                 max_revisions=params['max_revisions'],
+                                 num_users=params['users'],
+                                 mix=params['mix'],
+                                 seed=params['seed'])
+
+    books_file = os.path.join(directory, 'books.tsv')
+    booklist_cache = os.path.join(directory, 'books.tsv.booklist_cache.json')
+    cache_file = os.path.join(directory, 'books.tsv.cache.db')
+    output = os.path.join(directory, 'results.tsv')
+    output_html = os.path.join(directory, 'index.html')
+
+    start = time.perf_counter()
+    stats = synthetic.write_contest(directory, books, cache_file)
+    stats['setup'] = time.perf_counter() - start
+
+    timings = dict()
+    timings['get_books'], _ = best_time(
+        lambda: score.get_books(books_file, booklist_cache),
+        repeat)
+    timings['get_score'], scores = best_time(
+        lambda: score.get_score(books_file,
+                                synthetic.CONTEST_START,
+                                synthetic.CONTEST_END,
+                                synthetic.LANG,
+                                booklist_cache,
+                                True,
+                                cache_file,
+                                workers=workers),
+        repeat)
+    timings['get_rows'], rows = best_time(lambda: score.get_rows(scores),
+                                          repeat)
+    timings['write_csv'], _ = best_time(lambda: score.write_csv(rows, output),
+                                        repeat)
+
+    resfiles = [output] * NUM_RESULTS
+    timings['merge.get_ranking'], ranking = best_time(
+        lambda: merge.get_ranking(resfiles),
+        repeat)
+    timings['merge.write_html'], _ = best_time(
+        lambda: merge.write_html(ranking,
+                                 synthetic.LANG,
+                                 TEMPLATE_FILE,
+                                 output_html),
+        repeat)
+
+    stats['users'] = len(rows)
+
+    # the same first books, generated again
+    fetch_books = synthetic.make_books(min(num_books, FETCH_BOOKS),
+                                       min_pages=params['min_pages'],
+                                       max_pages=params['max_pages'],
+                                       max_revisions=params['max_revisions'],
+                                       num_users=params['users'],
+                                       mix=params['mix'],
+                                       seed=params['seed'])
+    timings['fetch_batch (1 page)'], stats['fetch_requests'] = time_fetch(
+        fetch_books, repeat)
+
+    return {'books': num_books,
+            'stats': stats,
+            'timings': timings
+            }
+
+
+def compare(report, old_report):
+    old_results = dict((result['books'], result)
+                       for result in old_report['results'])
+
+    print('{:<20} {:>8} {:>12} {:>12} {:>8}'.format('benchmark', 'books',
+                                                    'old (s)', 'new (s)',
+                                                    'ratio'))
+    for result in report['results']:
+        old_result = old_results.get(result['books'])
+        if old_result is None:
+            continue
+
+        for name, elapsed in sorted(result['timings'].items()):
+            old_elapsed = old_result['timings'].get(name)
+            if not old_elapsed:
+                continue
+            print('{:<20} {:>8} {:>12.4f} {:>12.4f} {:>8.2f}'
+                  .format(name, result['books'], old_elapsed, elapsed,
+                          elapsed / old_elapsed))
+
+
+def main(config):
+    report = {'date': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+              'commit': get_commit(),
+              'python': platform.python_version(),
+              'numpy': scoring.np is not None,
+              'params': config['params'],
+              'repeat': config['repeat'],
+              'workers': config['workers'],
+              'results': []
+              }
+
+    for num_books in config['scales']:
+        directory = tempfile.mkdtemp(prefix='wscontest-benchmark-')
+        try:
+            result = run_scale(num_books,
+                               directory,
+                               config['params'],
+                               config['repeat'],
+                               config['workers'])
+        finally:
+            if config['keep']:
+                print('Files of the contest with {} books: {}'
+                      .format(num_books, directory), file=sys.stderr)
+            else:
+                shutil.rmtree(directory)
+
+        report['results'].append(result)
+
+        for name, elapsed in sorted(result['timings'].items()):
+            print('{:<20} {:>8} books {:>12.4f} s'.format(name, num_books,
+                                                         elapsed))
+
+    with codecs.open(config['output'], 'w', 'utf-8') as f:
+        json.dump(report, f)
+
+    if config['compare']:
+        with codecs.open(config['compare'], 'r', 'utf-8') as f:
+            old_report = json.load(f)
+        compare(report, old_report)
+
+
+if __name__ == '__main__':
+
+    DESCRIPTION = 'Time score.py and merge.py on synthetic contests of different sizes.'
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='Compare the timings with a previous report')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the files of the synthetic contests')
+    parser.add_argument('--max-pages', type=int, default=synthetic.MAX_PAGES, metavar='N',
+                        help='Maximum number of pages of a book (default: {})'.format(synthetic.MAX_PAGES))
+    parser.add_argument('--max-revisions', type=int, default=synthetic.MAX_REVISIONS, metavar='N',
+                        help='Maximum number of revisions of a page (default: {})'.format(synthetic.MAX_REVISIONS))
+    parser.add_argument('--min-pages', type=int, default=synthetic.MIN_PAGES, metavar='N',
+                        help='Minimum number of pages of a book (default: {})'.format(synthetic.MIN_PAGES))
+    parser.add_argument('--mix', metavar='UP,SKIP,REVERT,EDIT',
+                        default=','.join(str(synthetic.MIX[move])
+                                         for move in ('up', 'skip', 'revert', 'edit')),
+                        help='Weights of the quality transitions (default: %(default)s)')
+    parser.add_argument('-o', default=REPORT_FILE, metavar='REPORT',
+                        help='JSON file to write the report (default: {})'.format(REPORT_FILE))
+    parser.add_argument('-r', type=int, default=REPEAT, metavar='REPEAT',
+                        help='Number of repetitions, the best one is reported (default: {})'.format(REPEAT))
+    parser.add_argument('-s', default=','.join(str(scale) for scale in SCALES), metavar='SCALES',
+                        help='Comma-separated numbers of books (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic contests (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=synthetic.NUM_USERS, metavar='N',
+                        help='Number of users (default: {})'.format(synthetic.NUM_USERS))
+    parser.add_argument('--workers', type=int, default=score.WORKERS, metavar='N',
+                        help='Number of worker processes of get_score (default: {})'.format(score.WORKERS))
+
+    args = parser.parse_args()
+
+    config = dict()
+    config['params'] = {'min_pages': args.min_pages,
+                        'max_pages': args.max_pages,
+                        'max_revisions': args.max_revisions,
+                        'users': args.users,
+                        'mix': dict(zip(('up', 'skip', 'revert', 'edit'),
+                                        (int(w) for w in args.mix.split(',')))),
+                        'seed': args.seed
+                        }
+    config['scales'] = [int(scale) for scale in args.s.split(',')]
+    config['repeat'] = args.r
+    config['workers'] = args.workers
+    config['output'] = args.o
+    config['compare'] = args.compare
+    config['keep'] = args.keep
+
+    # see merge.console
+    logging.getLogger().removeHandler(merge.console)
+    logging.getLogger().setLevel(logging.WARNING)
+    score.logger.setLevel(logging.WARNING)
+
+    main(config)
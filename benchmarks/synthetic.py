@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmarks/synthetic.py
+Synthetic books and revision histories for the benchmarks.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+Every page gets a random number of revisions, each one moving the quality
+level of the page according to a mix of transitions:
+  * up: the level goes up by one (SAL 0/25% -> SAL 50% -> SAL 75% -> SAL 100%);
+  * skip: the page is proofread directly (SAL 75%);
+  * revert: the level goes down by one;
+  * edit: the level does not change.
+Revisions are spread over a period starting before the contest and ending
+after it. The pages are in the format returned by the API to
+get_page_revisions(), and can be stored in a cache (see write_contest()) so
+that score.py can run without requests to Wikisource.
+"""
+
+import os
+import time
+import random
+import codecs
+import calendar
+from datetime import datetime
+
+# Try to use yajl, a faster module for JSON
+# import json
+try:
+    import yajl as json
+except ImportError:
+    import json
+
+from revcache import RevisionCache
+
+
+### GLOBALS AND DEFAULTS ###
+LANG = 'it'
+CONTEST_START = datetime(2017, 11, 24)
+CONTEST_END = datetime(2017, 12, 8, 23, 59, 59)
+# revisions are made between PERIOD_START and PERIOD_END
+PERIOD_START = datetime(2017, 10, 1)
+PERIOD_END = datetime(2018, 1, 31)
+
+MIN_PAGES = 5
+MAX_PAGES = 50
+MAX_REVISIONS = 5
+NUM_USERS = 100
+# fraction of pages that do not exist
+MISSING = 0.1
+MIX = {'up': 4, 'skip': 2, 'revert': 1, 'edit': 1}
+# size (in characters) of the text of every revision
+TEXT_SIZE = 500
+### ###
+
+
+def make_history(rnd, num_revisions, users, mix, text_size=TEXT_SIZE):
+    """Return the revisions of a page, oldest first, as (timestamp, user, level).
+    """
+    start = calendar.timegm(PERIOD_START.timetuple())
+    end = calendar.timegm(PERIOD_END.timetuple())
+    timestamps = sorted(rnd.randint(start, end) for _ in range(num_revisions))
+
+    moves = list(mix.keys())
+    weights = [mix[move] for move in moves]
+
+    level = None
+    history = []
+    for timestamp in timestamps:
+        move = rnd.choices(moves, weights)[0]
+        if level is None:
+            level = rnd.randint(0, 2) if move != 'skip' else 3
+        elif move == 'up':
+            level = min(level + 1, 4)
+        elif move == 'skip':
+            level = max(level, 3)
+        elif move == 'revert':
+            level = max(level - 1, 0)
+
+        history.append((timestamp, rnd.choice(users), level))
+
+    return history
+
+
+def make_page_data(book, page, history, revid, text_size=TEXT_SIZE):
+    """Return history in the format returned by the API for a page.
+
+    revid is the revid of the first revision, the following ones are numbered
+    sequentially.
+    """
+    title = 'Page:{book}/{page}'.format(book=book, page=page)
+
+    if not history:
+        return {'query': {'pages': {'-1': {'ns': 104,
+                                           'title': title,
+                                           'missing': ''}}}}
+
+    revisions = []
+    for i, (timestamp, user, level) in enumerate(history):
+        text = ('<noinclude><pagequality level="{level}" user="{user}" />'
+                '</noinclude>'.format(level=level, user=user))
+        text += 'x' * (text_size - len(text))
+        revisions.append({'revid': revid + i,
+                          'parentid': revid + i - 1 if i else 0,
+                          'user': user,
+                          'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                     time.gmtime(timestamp)),
+                          '*': text
+                          })
+
+    # the API returns the newest revision first
+    return {'query': {'pages': {str(revid): {'ns': 104,
+                                             'title': title,
+                                             'revisions': revisions[::-1]}}}}
+
+
+def make_books(num_books,
+               min_pages=MIN_PAGES,
+               max_pages=MAX_PAGES,
+               max_revisions=MAX_REVISIONS,
+               num_users=NUM_USERS,
+               missing=MISSING,
+               mix=None,
+               text_size=TEXT_SIZE,
+               seed=0):
+    """Generate num_books books.
+
+    Yields (book, number of pages, pages), where pages is a list of the API
+    responses of the pages of the book.
+    """
+    rnd = random.Random(seed)
+    users = ['User{}'.format(i) for i in range(num_users)]
+    mix = mix or MIX
+
+    revid = 1
+    for i in range(num_books):
+        book = 'Book {}.djvu'.format(i)
+        num_pages = rnd.randint(min_pages, max_pages)
+
+        pages = []
+        for page in range(1, num_pages + 1):
+            history = []
+            if rnd.random() >= missing:
+                history = make_history(rnd,
+                                       rnd.randint(1, max_revisions),
+                                       users,
+                                       mix,
+                                       text_size)
+            pages.append(make_page_data(book, page, history, revid, text_size))
+            revid += len(history)
+
+        yield book, num_pages, pages
+
+
+def write_contest(directory, books, cache_file=None, lang=LANG):
+    """Write the files of a contest with books in directory.
+
+    books are generated by make_books(). Writes books.tsv, its booklist cache
+    and contest.conf.ini, and stores the pages in the cache cache_file.
+    Returns a dict with the number of books, pages and revisions.
+    """
+    cache = None
+    if cache_file is not None:
+        cache = RevisionCache(cache_file)
+
+    stats = {'books': 0, 'pages': 0, 'revisions': 0}
+    booklist = dict()
+    with codecs.open(os.path.join(directory, 'books.tsv'), 'w', 'utf-8') as f:
+        for book, num_pages, pages in books:
+            f.write('{}\n'.format(book))
+            booklist[book] = num_pages
+
+            stats['books'] += 1
+            stats['pages'] += num_pages
+            for page, data in enumerate(pages, 1):
+                page_data = list(data['query']['pages'].values())[0]
+                stats['revisions'] += len(page_data.get('revisions', []))
+                if cache is not None:
+                    cache.put(lang, book, page, data, commit=False)
+
+            if cache is not None:
+                cache.commit()
+
+    if cache is not None:
+        cache.close()
+
+    booklist_cache = os.path.join(directory, 'books.tsv.booklist_cache.json')
+    with codecs.open(booklist_cache, 'w', 'utf-8') as f:
+        json.dump({'CACHE_BOOKS_LIST': booklist}, f)
+
+    with codecs.open(os.path.join(directory, 'contest.conf.ini'), 'w',
+                     'utf-8') as f:
+        f.write('[contest]\n'
+                'start_date = {start}\n'
+                'end_date = {end}\n'
+                'language = {lang}\n'
+                .format(start=CONTEST_START.strftime('%Y-%m-%d %H:%M:%S'),
+                        end=CONTEST_END.strftime('%Y-%m-%d %H:%M:%S'),
+                        lang=lang))
+
+    return stats
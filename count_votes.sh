@@ -135,17 +135,14 @@ NUM_BOOKS=$(wc -l < 'united')
 echodebug "NUM_BOOKS: $NUM_BOOKS"
 echodebug "num_chunks: $num_chunks"
 
-if ((NUM_BOOKS % num_chunks)); then
-  BOOKS_PER_FILE=$((NUM_BOOKS/num_chunks+1))
-else
-  BOOKS_PER_FILE=$((NUM_BOOKS/num_chunks))
-fi
+# the booklist cache is shared by all the sub-lists
+booklist_cache="${book_file}.booklist_cache.json"
 
-echoverbose "Each list will contain $BOOKS_PER_FILE books"
-split -l "$BOOKS_PER_FILE" \
-    --numeric-suffixes=01 \
-    --additional-suffix="_sublist.tsv" \
-    'united' books
+echoverbose "Balancing the lists by number of pages"
+"$(command -v python3)" split_books.py \
+    --booklist-cache "$booklist_cache" \
+    -f 'united' \
+    -n "$num_chunks"
 
 if $no_keep_files; then
   rm -f 'united'
@@ -154,7 +151,7 @@ NUM_BOOK_LISTS=$(find . -mindepth 1 -maxdepth 1 -name 'books*_sublist.tsv' \
                  | wc -l)
 
 echoverbose
-echoverbose "There are $NUM_BOOK_LISTS sub-lists with $BOOKS_PER_FILE books per list"
+echoverbose "There are $NUM_BOOK_LISTS sub-lists"
 
 echoverbose
 echoverbose "***********************************************"
@@ -187,13 +184,17 @@ set +e
 # score.py process can end with:
 #   src/tcmalloc.cc:278] Attempt to free invalid pointer
 # disabling -e while we figure out this problem.
+# Failed jobs are run again, resuming from the books already scored.
 seq -w 01 "$NUM_BOOK_LISTS" | \
     parallel "$print_processes_flag" "$files_flag" \
         --jobs "$num_jobs" \
+        --retries 3 \
         ${parallel_verbosity} \
         --results output_dir \
         "$(command -v python3)" score.py "$verbosity" \
+            --resume \
             --config "$config" \
+            --booklist-cache "$booklist_cache" \
             -f books{}_sublist.tsv \
             -o results{}_sublist.tsv
 set -e
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+dumps.py
+Read the pages of the books from MediaWiki XML history dumps.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+History dumps (pages-meta-history*.xml, also compressed with bzip2 or gzip)
+contain every revision of every page of a wiki, they are read incrementally
+one page at a time, so that the memory used does not depend on the size of
+the dump. Only the pages of the Page namespace that belong to the books are
+returned, in the same format of the responses of the API.
+
+See <https://meta.wikimedia.org/wiki/Data_dumps/Dump_format>.
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import bz2
+import gzip
+import logging
+import xml.etree.ElementTree as ET
+
+
+### GLOBALS AND DEFAULTS ###
+# first bytes of the compressed files
+BZIP2_MAGIC = b'BZh'
+GZIP_MAGIC = b'\x1f\x8b'
+### ###
+
+logger = logging.getLogger('score')
+
+
+def open_dump(dump_file):
+    """Open dump_file for reading, decompressing it if needed."""
+    with open(dump_file, 'rb') as f:
+        magic = f.read(3)
+
+    if magic.startswith(BZIP2_MAGIC):
+        return bz2.open(dump_file, 'rb')
+    elif magic.startswith(GZIP_MAGIC):
+        return gzip.open(dump_file, 'rb')
+    else:
+        return open(dump_file, 'rb')
+
+
+def normalize_title(title):
+    return title.replace('_', ' ').strip()
+
+
+def match_page(title, ns, books, namespace=None):
+    """Return (book, page) if title is a page of one of books, else None.
+
+    books maps the normalized names of the books to their names. With
+    namespace, only the pages of that namespace (its number) are considered,
+    otherwise the pages of any namespace that is not a talk namespace.
+    """
+    if namespace is None:
+        if ns <= 0 or ns % 2:
+            return None
+    elif ns != namespace:
+        return None
+
+    # the name of the namespace is localized, e.g. Page:, Pagina:, Seite:
+    if ':' not in title:
+        return None
+    book, _, page = title.split(':', 1)[1].rpartition('/')
+    if not page.isdigit():
+        return None
+
+    book = books.get(normalize_title(book))
+    if book is None:
+        return None
+
+    return book, int(page)
+
+
+def _revision(elem, ns):
+    """Return a revision element as a revision returned by the API."""
+    contributor = elem.find(ns + 'contributor')
+    user = None
+    if contributor is not None:
+        user = contributor.findtext(ns + 'username') or \
+            contributor.findtext(ns + 'ip')
+
+    text = elem.find(ns + 'text')
+    if text is None or 'deleted' in text.attrib:
+        text = None
+    else:
+        text = text.text or ''
+
+    return {'revid': int(elem.findtext(ns + 'id')),
+            'parentid': int(elem.findtext(ns + 'parentid') or 0),
+            'user': user or '',
+            'timestamp': elem.findtext(ns + 'timestamp'),
+            '*': text
+            }
+
+
+def iter_dump_pages(dump_file, books, namespace=None):
+    """Yield (book, page, data) for the pages of books in dump_file.
+
+    data is in the same format of the response of the API to a request of the
+    revisions of the page (see score.fetch_page_revisions()), with all the
+    revisions of the page in the dump. Revisions whose text has been deleted
+    are left out, since their quality level is not known.
+    """
+    books = dict((normalize_title(book), book) for book in books)
+
+    with open_dump(dump_file) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+
+        # elements are in the namespace of the version of the export format,
+        # e.g. {http://www.mediawiki.org/xml/export-0.10/}page
+        ns = root.tag[:root.tag.index('}') + 1] if '}' in root.tag else ''
+        page_tag = ns + 'page'
+        title_tag = ns + 'title'
+        ns_tag = ns + 'ns'
+        revision_tag = ns + 'revision'
+
+        title = None
+        page_ns = None
+        match = None
+        revisions = []
+        for event, elem in context:
+            if event != 'end':
+                continue
+
+            tag = elem.tag
+            if tag == revision_tag:
+                if match is not None:
+                    rev = _revision(elem, ns)
+                    if rev['*'] is not None:
+                        revisions.append(rev)
+                    else:
+                        logger.debug("Skipping revision {} of '{}', its "
+                                     "text has been deleted"
+                                     .format(rev['revid'], title))
+                elem.clear()
+            elif tag == title_tag:
+                title = elem.text
+            elif tag == ns_tag:
+                page_ns = int(elem.text)
+                match = match_page(title, page_ns, books, namespace)
+            elif tag == page_tag:
+                if match is not None:
+                    book, page = match
+                    # the API returns the newest revision first
+                    revisions.reverse()
+                    data = {'query': {'pages': {
+                        elem.findtext(ns + 'id'): {'ns': page_ns,
+                                                   'title': title,
+                                                   'revisions': revisions
+                                                   }}}}
+                    yield book, page, data
+
+                title = None
+                page_ns = None
+                match = None
+                revisions = []
+                # drop the pages already read
+                root.clear()
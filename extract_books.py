@@ -48,21 +48,13 @@ THE SOFTWARE.
 
 import regex
 import csv
-import time
 import logging
 import argparse
 import configparser
 from datetime import datetime, timedelta
-import urllib.parse
-import urllib.request
 import mwparserfromhell
 
-# Try to use yajl, a faster module for JSON
-# import json
-try:
-    import yajl as json
-except ImportError:
-    import json
+import wsapi
 
 ### GLOBALS AND DEFAULTS ###
 # Files
@@ -123,27 +115,17 @@ def get_page_revisions(page, lang):
         'rvlimit': RVLIMIT,
         'rvprop': 'user|timestamp|content'
     }
-    params = urllib.parse.urlencode(params).encode('ascii')
     logger.info("\tRequesting '{page}'".format(page=page))
 
-    retries_counter = 0
-    retry_fetch = True
-    data = {}
-
     if lang in OLDWIKISOURCE_PREFIXES:
         wikisource_api = OLDWIKISOURCE_API
     else:
         wikisource_api = WIKISOURCE_API.format(lang=lang)
 
-    while retry_fetch and retries_counter < MAX_RETRIES:
-        try:
-            f = urllib.request.urlopen(source_api, params)
-            data = json.loads(f.read().decode('utf-8'))
-            retry_fetch = False
-        except:
-            time.sleep(WAIT_TIME)
-            retries_counter += 1
-            retry_fetch = True
+    data = wsapi.api_request_retry(wikisource_api,
+                                   params,
+                                   max_retries=MAX_RETRIES,
+                                   wait_time=WAIT_TIME)
 
     page_id = int([k for k in data['query']['pages'].keys()][0])
     revisions = data['query']['pages'][str(page_id)]['revisions']
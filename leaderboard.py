@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+leaderboard.py
+Serve the live leaderboard of the Wikisource contest.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+usage: leaderboard.py [-h] [--batch] [--booklist-cache BOOKLIST_CACHE]
+                      [--concurrency N] [--config CONFIG_FILE] [-d]
+                      [-f BOOKS_FILE] [--host HOST]
+                      [--html-template TEMPLATE_FILE] [--interval SECONDS]
+                      [--port PORT] [-v] [--window]
+
+Serve the live leaderboard of the Wikisource contest.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --batch               Request the pages in batches of 50 titles
+  --booklist-cache BOOKLIST_CACHE
+                        JSON file to read and store the booklist cache
+                        (default: {BOOKS_FILE}.booklist_cache.json)
+  --concurrency N       Number of concurrent requests to the Wikisource API
+                        (default: 1)
+  --config CONFIG_FILE  INI file to read configs (default: contest.conf.ini)
+  -d                    Enable debug output (implies -v)
+  -f BOOKS_FILE         TSV file with the books to be processed (default:
+                        books.tsv)
+  --host HOST           Address to listen on (default: 127.0.0.1)
+  --html-template TEMPLATE_FILE
+                        Template file for the HTML output (default:
+                        index.template.html)
+  --interval SECONDS    Seconds between two requests of the new revisions
+                        (default: 300)
+  --port PORT           Port to listen on (default: 8000)
+  -v                    Enable verbose output
+  --window              Request only the revisions made around the contest
+                        dates
+
+---
+The pages of the books are requested and scored once at startup, as score.py
+does, then the last revision, the quality level and the points of every page
+are kept in memory. Every --interval seconds only the revisions made since the
+last update are listed with the recent changes of the Page namespace, only the
+new revisions of those pages are requested and scored, and the points of the
+pages are updated. The totals are computed again, in the same way as score.py, only
+for the books with new revisions, and the leaderboard is rendered again only
+when the totals change.
+
+The leaderboard is served at:
+  * /, /index.html: the HTML leaderboard, rendered with the template of
+    merge.py ({{{aggiornamento}}} is replaced with the time of the last
+    update);
+  * /results.json: the rows of the leaderboard, with the time of the last
+    update.
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import time
+import logging
+import calendar
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Try to use yajl, a faster module for JSON
+# import json
+try:
+    import yajl as json
+except ImportError:
+    import json
+
+import score
+import merge
+import wsapi
+from merge import CSV_FIELDS
+
+
+### GLOBALS AND DEFAULTS ###
+# Files
+BOOKS_FILE = 'books.tsv'
+BOOKLIST_CACHE_FILE = '{BOOKS_FILE}.booklist_cache.json'
+CONFIG_FILE = 'contest.conf.ini'
+TEMPLATE_FILE = 'index.template.html'
+
+# params
+HOST = '127.0.0.1'
+PORT = 8000
+# seconds between two requests of the new revisions
+INTERVAL = 300
+# the recent changes are listed from this many seconds before the last
+# update, since edits can reach them with some delay
+POLL_OVERLAP = 60
+CONCURRENCY = 1
+### ###
+
+# logging is configured by score.py
+logger = logging.getLogger('score')
+
+
+class Leaderboard(object):
+    """Points of the pages of books in the contest, kept up to date.
+
+    books is a list of (book, number of pages), contest_start and
+    contest_end are timestamps in seconds since the epoch.
+    """
+
+    def __init__(self,
+                 books,
+                 lang,
+                 contest_start,
+                 contest_end,
+                 concurrency=CONCURRENCY):
+        self.books = books
+        self.lang = lang
+        self.contest_start = contest_start
+        self.contest_end = contest_end
+        self.concurrency = concurrency
+
+        # (book, page) -> {'revid', 'state', 'scores'}, state is the
+        # (quality, user, timestamp) of the last revision of the page
+        self.pages = dict()
+        # scores of every book, in the order of books
+        self.books_scores = [score.empty_scores() for _ in books]
+        self.totals = None
+
+        # Page namespace, None if the wiki has none (then all the pages are
+        # requested at every update)
+        self.namespace = None
+        # time of the last update, the edits are listed from here
+        self.polled = None
+        # pages whose request failed, requested again at the next update
+        self.failed = set()
+
+    def _update_page(self, book, pag, revs):
+        """Score the new revisions revs of a page."""
+        page = self.pages.get((book, pag))
+        state = page['state'] if page is not None else None
+
+        book_scores, _, states = score.score_pages(book,
+                                                   [(pag, revs, state)],
+                                                   self.contest_start,
+                                                   self.contest_end)
+
+        if page is None:
+            page = {'revid': None,
+                    'state': None,
+                    'scores': score.empty_scores()
+                    }
+            self.pages[(book, pag)] = page
+
+        for page_values, values in zip(page['scores'], book_scores):
+            for user, value in values.items():
+                page_values[user] += value
+
+        if revs:
+            page['revid'] = revs[-1].revid
+        page['state'] = states[0]
+
+    def _sum_book(self, i):
+        book, end = self.books[i]
+        book_scores = score.empty_scores()
+        for pag in range(1, end + 1):
+            page = self.pages.get((book, pag))
+            if page is None:
+                continue
+            for scores, page_values in zip(book_scores, page['scores']):
+                for user, value in page_values.items():
+                    scores[user] += value
+
+        self.books_scores[i] = book_scores
+
+    def load(self, batch=False, window=None):
+        """Request and score all the pages of the books."""
+        self.namespace = score.get_page_namespace(self.lang)
+        if self.namespace is None:
+            logger.warning("No Page namespace on the Wikisource of '{}', all "
+                           "the pages will be requested at every update"
+                           .format(self.lang))
+        # the edits made while the pages are requested are listed at the
+        # first update
+        self.polled = int(time.time())
+
+        pages = [(book, pag)
+                 for book, end in self.books
+                 for pag in range(1, end + 1)]
+        revisions = score.prefetch_revisions(pages,
+                                             self.lang,
+                                             concurrency=self.concurrency,
+                                             batch=batch,
+                                             window=window)
+
+        for (book, pag), (_, _, revs, _) in zip(pages, revisions):
+            self._update_page(book, pag, revs)
+
+        for i in range(len(self.books)):
+            self._sum_book(i)
+        self.totals = score.sum_scores(self.books_scores)
+
+    def _fetch_new(self, book, pag):
+        page = self.pages[(book, pag)]
+        revid = page['revid']
+
+        try:
+            # pages without revisions may have been created in the meantime
+            if revid is None:
+                data = score.fetch_page_revisions(book, pag, self.lang)
+                return score.decode_revisions(data)
+
+            data = score.fetch_new_revisions(book, pag, self.lang, revid)
+        except wsapi.RequestFailed as err:
+            # the page is requested again at the next update
+            logger.error(err)
+            return None
+
+        return [rev for rev in score.decode_revisions(data)
+                if rev.revid is not None and rev.revid > revid]
+
+    def _edited_pages(self, now):
+        """Return the pages edited since the last update, in books order."""
+        if self.namespace is None:
+            return [(book, pag)
+                    for book, end in self.books
+                    for pag in range(1, end + 1)]
+
+        edited = score.get_edited_pages(self.books,
+                                        self.lang,
+                                        self.namespace,
+                                        self.polled - POLL_OVERLAP,
+                                        now)
+
+        pages = set(self.failed)
+        pages.update((book, pag)
+                     for book, pags in edited.items()
+                     for pag in pags)
+
+        index = dict((book, i) for i, (book, _) in enumerate(self.books))
+        return sorted(pages, key=lambda page: (index[page[0]], page[1]))
+
+    def update(self):
+        """Request and score the revisions made since the last update.
+
+        Only the pages edited since the last update are requested. Returns
+        True if the totals have changed.
+        """
+        now = int(time.time())
+        try:
+            pages = self._edited_pages(now)
+        except wsapi.RequestFailed as err:
+            # the edits are listed again at the next update
+            logger.error(err)
+            return False
+
+        self.polled = now
+        self.failed = set()
+
+        changed = set()
+        index = dict((book, i) for i, (book, _) in enumerate(self.books))
+        with ThreadPoolExecutor(max_workers=max(self.concurrency, 1)) \
+                as executor:
+            for (book, pag), revs in zip(pages,
+                                         executor.map(
+                                             lambda page: self._fetch_new(*page),
+                                             pages)):
+                if revs is None:
+                    self.failed.add((book, pag))
+                elif revs:
+                    logger.info("{} new revisions of '{}/{}'"
+                                .format(len(revs), book, pag))
+                    self._update_page(book, pag, revs)
+                    changed.add(index[book])
+
+        if not changed:
+            return False
+
+        for i in changed:
+            self._sum_book(i)
+
+        totals = score.sum_scores(self.books_scores)
+        if score.get_rows(totals) == score.get_rows(self.totals):
+            return False
+
+        self.totals = totals
+        return True
+
+    def get_ranking(self):
+        """Return the totals as the ranking of merge.py."""
+        return dict((user, {'punts': punts,
+                            'vali': vali,
+                            'revi': revi,
+                            'revi2': revi2,
+                            'revi3': revi3,
+                            'revi5': revi5
+                            })
+                    for user, punts, vali, revi, revi2, revi3, revi5
+                    in score.get_rows(self.totals))
+
+
+class Output(object):
+    """The pages served, rendered again when the leaderboard changes."""
+
+    def __init__(self, leaderboard, template):
+        self.leaderboard = leaderboard
+        self.template = template
+        self._lock = threading.Lock()
+        self.pages = dict()
+
+    def render(self):
+        ranking = self.leaderboard.get_ranking()
+        updated = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime())
+
+        html = merge.render_html(ranking, self.leaderboard.lang, self.template)
+        html = html.replace('{{{aggiornamento}}}', updated)
+
+        results = {'language': self.leaderboard.lang,
+                   'updated': updated,
+                   'rows': [dict(zip(CSV_FIELDS, row))
+                            for row in merge.get_rows(ranking)]
+                   }
+
+        pages = {'/': ('text/html; charset=utf-8', html.encode('utf-8')),
+                 '/results.json': ('application/json',
+                                   json.dumps(results).encode('utf-8'))
+                 }
+        pages['/index.html'] = pages['/']
+
+        with self._lock:
+            self.pages = pages
+
+        logger.info("Leaderboard updated: {} users".format(len(ranking)))
+
+    def get(self, path):
+        with self._lock:
+            return self.pages.get(path)
+
+
+def make_handler(output):
+
+    class LeaderboardHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            page = output.get(self.path.split('?', 1)[0])
+            if page is None:
+                self.send_error(404)
+                return
+
+            content_type, content = page
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            logger.debug("{} - {}".format(self.address_string(),
+                                          format % args))
+
+    return LeaderboardHandler
+
+
+def main(config):
+    lang = config['contest']['language']
+    contest_start = datetime.strptime(config['contest']['start_date'], "%Y-%m-%d %H:%M:%S")
+    contest_end = datetime.strptime(config['contest']['end_date'], "%Y-%m-%d %H:%M:%S")
+    contest_start = calendar.timegm(contest_start.timetuple())
+    contest_end = calendar.timegm(contest_end.timetuple())
+    concurrency = config['concurrency']
+
+    window = None
+    if config['window']:
+        window = (contest_start, contest_end)
+
+    with open(config['html_template'], 'r') as f:
+        template = f.read()
+
+    books = score.get_books(config['books_file'],
+                            config['booklist_cache'],
+                            concurrency)
+
+    wsapi.set_host_limit(score.get_wikisource_api(lang), concurrency)
+
+    leaderboard = Leaderboard(books, lang, contest_start, contest_end,
+                              concurrency)
+    logger.info("Scoring {} books".format(len(books)))
+    leaderboard.load(config['batch'], window)
+
+    output = Output(leaderboard, template)
+    output.render()
+
+    server = ThreadingHTTPServer((config['host'], config['port']),
+                                 make_handler(output))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.warning("Serving the leaderboard on http://{}:{}/"
+                   .format(config['host'], config['port']))
+
+    try:
+        while True:
+            time.sleep(config['interval'])
+            if leaderboard.update():
+                output.render()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    DESCRIPTION = 'Serve the live leaderboard of the Wikisource contest.'
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--batch', action='store_true',
+                        help='Request the pages in batches of {} titles'.format(score.BATCH_SIZE))
+    parser.add_argument('--booklist-cache', default=BOOKLIST_CACHE_FILE, metavar='BOOKLIST_CACHE',
+                        help='JSON file to read and store the booklist cache (default: {})'.format(BOOKLIST_CACHE_FILE))
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, metavar='N',
+                        help='Number of concurrent requests to the Wikisource API (default: {})'.format(CONCURRENCY))
+    parser.add_argument('--config', default=CONFIG_FILE, metavar='CONFIG_FILE',
+                        help='INI file to read configs (default: {})'.format(CONFIG_FILE))
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Enable debug output (implies -v)')
+    parser.add_argument('-f', default=BOOKS_FILE, metavar='BOOKS_FILE',
+                        help='TSV file with the books to be processed (default: {})'.format(BOOKS_FILE))
+    parser.add_argument('--host', default=HOST,
+                        help='Address to listen on (default: {})'.format(HOST))
+    parser.add_argument('--html-template', default=TEMPLATE_FILE, metavar='TEMPLATE_FILE',
+                        help='Template file for the HTML output (default: {})'.format(TEMPLATE_FILE))
+    parser.add_argument('--interval', type=int, default=INTERVAL, metavar='SECONDS',
+                        help='Seconds between two requests of the new revisions (default: {})'.format(INTERVAL))
+    parser.add_argument('--port', type=int, default=PORT,
+                        help='Port to listen on (default: {})'.format(PORT))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Enable verbose output')
+    parser.add_argument('--window', action='store_true',
+                        help='Request only the revisions made around the contest dates')
+
+    args = parser.parse_args()
+
+    config = score.read_config(args.config)
+    config['books_file'] = args.f
+    if "BOOKS_FILE" in args.booklist_cache:
+        config['booklist_cache'] = args.booklist_cache.format(
+            BOOKS_FILE=config['books_file'])
+    else:
+        config['booklist_cache'] = args.booklist_cache
+    config['html_template'] = args.html_template
+    config['concurrency'] = args.concurrency
+    config['batch'] = args.batch
+    config['window'] = args.window
+    config['host'] = args.host
+    config['port'] = args.port
+    config['interval'] = args.interval
+
+    # Verbosity/Debug
+    config['verbose'] = args.verbose or args.debug
+    config['debug'] = args.debug
+
+    lvl_config_logger = logging.WARNING
+    if config['verbose']:
+        lvl_config_logger = logging.INFO
+
+    if config['debug']:
+        lvl_config_logger = logging.DEBUG
+
+    # see merge.console
+    logging.getLogger().removeHandler(merge.console)
+    formatter = logging.Formatter(score.LOGFORMAT_STDOUT[lvl_config_logger])
+    score.console.setFormatter(formatter)
+    score.rootlogger.setLevel(lvl_config_logger)
+    logger.setLevel(lvl_config_logger)
+
+    logger.debug(args)
+    logger.debug(config)
+
+    try:
+        main(config)
+    except wsapi.RequestFailed as err:
+        logger.error(err)
+        exit(1)
+
+    exit(0)
@@ -9,8 +9,10 @@ usage: merge.py [-h] [--booklist [BOOKLIST_FILE [BOOKLIST_FILE ...]]]
                 [--booklist-output BOOKLIST_OUTPUT]
                 [--cache [CACHE_FILE [CACHE_FILE ...]]]
                 [--cache-output CACHE_OUTPUT] [--config CONFIG_FILE] [-d]
-                [-o OUTPUT_TSV] [--html] [--html-output OUTPUT_HTML]
-                [--html-template TEMPLATE_FILE] [-v]
+                [--metrics-output METRICS_FILE] [-o OUTPUT_TSV]
+                [--prometheus PROM_FILE] [--html]
+                [--html-output OUTPUT_HTML] [--html-template TEMPLATE_FILE]
+                [-v]
                 FILE1 ...
 
 Merge results from score.py.
@@ -27,13 +29,20 @@ optional arguments:
                         JSON file to store the merged cache (requires
                         --booklist) (default: booklist_cache_tot.tsv)
   --cache [CACHE_FILE [CACHE_FILE ...]]
-                        Merge cache files
+                        Merge cache files (SQLite, directories or legacy
+                        JSON)
   --cache-output CACHE_OUTPUT
-                        JSON file to store the merged cache (requires --cache)
-                        (default: books_cache_tot.tsv)
+                        SQLite file or directory to store the merged cache
+                        (requires --cache) (default: books_cache_tot.db)
   --config CONFIG_FILE  INI file to read configs (default: contest.conf.ini)
   -d                    Enable debug output (implies -v)
+  --metrics-output METRICS_FILE
+                        JSON file to write the metrics of the run (default:
+                        {OUTPUT_TSV}.metrics.json)
   -o OUTPUT_TSV         Output file (default: results_tot.tsv)
+  --prometheus PROM_FILE
+                        Also write the metrics of the run in the Prometheus
+                        text format
   --html                Produce HTML output
   --html-output OUTPUT_HTML
                         Output file for the HTML output (default:
@@ -66,6 +75,7 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
+import os
 import csv
 import json
 import codecs
@@ -75,18 +85,27 @@ import configparser
 from html import escape
 from collections import defaultdict
 
+import metrics
+from revcache import open_cache, iter_json_cache
+
 ### GLOBALS AND DEFAULTS ###
 # Files
 OUTPUT_TSV = 'results_tot.tsv'
 BOOKLIST_OUTPUT = 'booklist_cache_tot.tsv'
-CACHE_OUTPUT = 'books_cache_tot.tsv'
+CACHE_OUTPUT = 'books_cache_tot.db'
 CONFIG_FILE = "contest.conf.ini"
 TEMPLATE_FILE = "index.template.html"
 OUTPUT_HTML = '{OUTPUT_TSV}.index.html'
+METRICS_OUTPUT = '{OUTPUT_TSV}.metrics.json'
 
 
 # Globals
 CSV_FIELDS = ['user', 'punts', 'vali', 'revi', 'revi2', 'revi3', 'revi5']
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+# params
+# number of pages written to the merged cache in a single transaction
+COMMIT_EVERY = 1000
 ### ###
 
 ### logging ###
@@ -109,6 +128,8 @@ console.setLevel(lvl_logger)
 formatter = logging.Formatter(LOGFORMAT_STDOUT[lvl_logger])
 console.setFormatter(formatter)
 
+# score.py adds a handler to the root logger too: the scripts that import
+# both modules remove this one, so that every message is logged once
 rootlogger.addHandler(console)
 
 logger = logging.getLogger('score')
@@ -207,12 +228,16 @@ def get_html_rows(ranking, lang):
             in get_rows(ranking)]
 
 
+def render_html(ranking, lang, template):
+    html_rows = get_html_rows(ranking, lang=lang)
+    return template.replace("{{{rows}}}", '\n'.join(html_rows))
+
+
 def write_html(ranking, lang, html_template, output_html):
     with open(html_template, 'r') as f:
         template = f.read()
 
-    html_rows = get_html_rows(ranking, lang=lang)
-    content = template.replace("{{{rows}}}", '\n'.join(html_rows))
+    content = render_html(ranking, lang, template)
     with codecs.open(output_html, 'w', 'utf-8') as f:
         f.write(content)
 
@@ -239,19 +264,136 @@ def read_cache(cache_file):
     return cache
 
 
-def merge_cache(cachefiles):
-    cache = dict()
+def merge_booklist(booklistfiles):
+    booklist = dict()
 
-    for cachef in cachefiles:
-        cache_part = read_cache(cachef)
+    for booklistf in booklistfiles:
+        booklist_part = read_cache(booklistf)
 
-        for key in cache_part.keys():
-            if key not in cache:
-                cache[key] = cache_part[key]
+        for key in booklist_part.keys():
+            if key not in booklist:
+                booklist[key] = booklist_part[key]
             else:
-                cache[key].update(cache_part[key])
+                booklist[key].update(booklist_part[key])
+
+    return booklist
+
+
+def is_sqlite(cache_file):
+    with open(cache_file, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def data_newest(data):
+    """Return the (revid, timestamp) of the newest revision in the response
+    of the API, (0, '') if none.
+    """
+    try:
+        pages = data['query']['pages'].values()
+    except (KeyError, AttributeError):
+        return 0, ''
+
+    revisions = [rev for page_data in pages
+                 for rev in page_data.get('revisions', [])]
+    # timestamps in the ISO 8601 format can be compared as strings
+    return (max((rev.get('revid') or 0 for rev in revisions), default=0),
+            max((rev.get('timestamp') or '' for rev in revisions),
+                default=''))
+
+
+def compact_newest(revisions):
+    """Return the (revid, timestamp) of the newest of compact revisions."""
+    return (max((revid or 0 for revid, _, _, _ in revisions), default=0),
+            max((timestamp for _, timestamp, _, _ in revisions), default=0))
+
+
+def is_newer(newest, other_newest):
+    """Compare the (revid, timestamp) of the newest revisions of two entries.
+
+    Caches written by older versions of score.py have no revids, their
+    entries are compared by the timestamp of their newest revision.
+    """
+    revid, timestamp = newest
+    other_revid, other_timestamp = other_newest
+    if revid and other_revid:
+        return revid > other_revid
+
+    return timestamp > other_timestamp
+
+
+def iter_cache_pages(cache_file, lang):
+    """Iterate over the pages of a cache, one at a time.
+
+    Yields (kind, key, value): kind is 'revisions', 'compact' or 'state'
+    and key is (lang, book, page) ((lang, book, page, contest) for states).
+    Legacy JSON caches are stored under lang.
+    """
+    if not os.path.isdir(cache_file) and not is_sqlite(cache_file):
+        for book, pages in iter_json_cache(cache_file):
+            # the booklist cache used to be stored in the same file
+            if book == 'CACHE_BOOKS_LIST':
+                continue
+
+            for page, data in pages.items():
+                yield 'revisions', (lang, book, page), data
+        return
+
+    source = open_cache(cache_file)
+    try:
+        for page_lang, book, page, data in source.iter_revisions():
+            yield 'revisions', (page_lang, book, page), json.loads(data)
+        for page_lang, book, page, revisions in source.iter_compact():
+            yield 'compact', (page_lang, book, page), revisions
+        for page_lang, book, page, contest, state in source.iter_states():
+            yield 'state', (page_lang, book, page, contest), state
+    finally:
+        source.close()
+
+
+def merge_cache(cachefiles, cache_output, lang):
+    """Merge the caches in cachefiles in the cache cache_output.
+
+    cache_output is a SQLite cache, or a sharded cache if it is a directory
+    (see revcache.ShardedCache).
+
+    Caches are read one page at a time. When a page is in more than one
+    cache, the entry with the newest revision is kept, see is_newer().
+    """
+    output = open_cache(cache_output)
+
+    get = {'revisions': output.get,
+           'compact': output.get_compact,
+           'state': output.get_state
+           }
+    put = {'revisions': output.put,
+           'compact': output.put_compact,
+           'state': output.put_state
+           }
+    newest = {'revisions': data_newest,
+              'compact': compact_newest,
+              'state': lambda state: (state['revid'], state['timestamp'])
+              }
+
+    count = 0
+    for cachef in cachefiles:
+        logger.info("Merging cache: {}...".format(cachef))
 
-    return cache
+        for kind, key, value in iter_cache_pages(cachef, lang):
+            current = get[kind](*key)
+            if current is None or \
+                    is_newer(newest[kind](value), newest[kind](current)):
+                put[kind](*key, value, commit=False)
+
+            count += 1
+            metrics.inc('merged_cache_entries')
+            if count % COMMIT_EVERY == 0:
+                output.commit()
+
+    output.close()
+
+    logger.info("Merged {} pages".format(count))
+
+    return count
 
 
 def write_cache(cache, cache_output):
@@ -265,7 +407,10 @@ def read_config(config_file):
     parser = configparser.ConfigParser()
     parser.read(config_file)
 
-    config['contest'] = dict([(k ,v) for k, v in parser['contest'].items()])
+    # the language of the first contest, see score.py
+    section = [section for section in parser.sections()
+               if section.split(' ', 1)[0] == 'contest'][0]
+    config['contest'] = dict([(k ,v) for k, v in parser[section].items()])
     return config
 
 
@@ -273,26 +418,39 @@ def main(resfiles, config):
 
     output = config['output']
 
-    ranking = get_ranking(resfiles)
-    write_results(ranking, output)
+    with metrics.timer('read'):
+        ranking = get_ranking(resfiles)
+    with metrics.timer('write'):
+        write_results(ranking, output)
 
     if config['html']:
         lang = config['contest']['language']
         output_html = config['html_output']
         html_template = config['html_template']
-        write_html(ranking, lang, html_template, output_html)
+        with metrics.timer('write_html'):
+            write_html(ranking, lang, html_template, output_html)
 
     if config['cache']:
         cachefiles = config['cache']
         cache_output = config['cache_output']
-        cache = merge_cache(cachefiles)
-        write_cache(cache, cache_output)
+        lang = config['contest']['language']
+        with metrics.timer('merge_cache'):
+            merge_cache(cachefiles, cache_output, lang)
 
     if config['booklist']:
         booklistfiles = config['booklist']
         booklist_output = config['booklist_output']
-        booklist = merge_cache(booklistfiles)
-        write_cache(booklist_output)
+        with metrics.timer('merge_booklist'):
+            booklist = merge_booklist(booklistfiles)
+            write_cache(booklist, booklist_output)
+
+    report = metrics.get_report('merge.py',
+                                results=resfiles,
+                                output=output,
+                                users=len(ranking))
+    metrics.write_report(report, config['metrics_output'])
+    if config['prometheus']:
+        metrics.write_prometheus(report, config['prometheus'])
 
 
 if __name__ == '__main__':
@@ -308,15 +466,19 @@ if __name__ == '__main__':
     parser.add_argument('--booklist-output', default=BOOKLIST_OUTPUT, metavar='BOOKLIST_OUTPUT',
                         help='JSON file to store the merged cache (requires --booklist) (default: {})'.format(BOOKLIST_OUTPUT))
     parser.add_argument('--cache', nargs='*', metavar='CACHE_FILE',
-                        help='Merge cache files')
+                        help='Merge cache files (SQLite, directories or legacy JSON)')
     parser.add_argument('--cache-output', default=CACHE_OUTPUT, metavar='CACHE_OUTPUT',
-                        help='JSON file to store the merged cache (requires --cache) (default: {})'.format(CACHE_OUTPUT))
+                        help='SQLite file or directory to store the merged cache (requires --cache) (default: {})'.format(CACHE_OUTPUT))
     parser.add_argument('--config', default=CONFIG_FILE, metavar='CONFIG_FILE',
                         help='INI file to read configs (default: {})'.format(CONFIG_FILE))
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Enable debug output (implies -v)')
+    parser.add_argument('--metrics-output', default=METRICS_OUTPUT, metavar='METRICS_FILE',
+                        help='JSON file to write the metrics of the run (default: {})'.format(METRICS_OUTPUT))
     parser.add_argument('-o', default=OUTPUT_TSV, metavar='OUTPUT_TSV',
                         help='Output file (default: {})'.format(OUTPUT_TSV))
+    parser.add_argument('--prometheus', metavar='PROM_FILE',
+                        help='Also write the metrics of the run in the Prometheus text format')
     parser.add_argument('--html', action='store_true',
                         help='Produce HTML output')
     parser.add_argument('--html-output', default=OUTPUT_HTML, metavar='OUTPUT_HTML',
@@ -354,6 +516,14 @@ if __name__ == '__main__':
     else:
         config['html_output'] = args.html_output
 
+    # Metrics
+    if "OUTPUT_TSV" in args.metrics_output:
+        config['metrics_output'] = args.metrics_output.format(
+            OUTPUT_TSV=config['output'])
+    else:
+        config['metrics_output'] = args.metrics_output
+    config['prometheus'] = args.prometheus
+
     config['verbose'] = args.verbose or args.debug
     config['debug'] = args.debug
 
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+Runtime metrics of the wscontest-votecounter scripts.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+Metrics are collected in this module while the scripts run:
+  * phases: the time spent in every phase (e.g. fetch, decode, score), see
+    timer(). Phases can run in more threads at the same time, so their times
+    are summed over all the threads and can be larger than the wall time;
+  * counters: e.g. requests, retries, cache hits and misses, bytes downloaded,
+    see inc();
+  * histograms: the latency of the requests to every host, see observe().
+
+The metrics of other processes can be added with merge(snapshot()). At the end
+of the run they are written as a JSON report with write_report(), including
+the peak resident set size, and optionally in the text format of Prometheus
+with write_prometheus().
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import time
+import codecs
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+# resource is not available on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Try to use yajl, a faster module for JSON
+# import json
+try:
+    import yajl as json
+except ImportError:
+    import json
+
+
+### GLOBALS AND DEFAULTS ###
+# upper bounds (in seconds) of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# prefix of the names of the metrics in the Prometheus format
+PROMETHEUS_PREFIX = 'wscontest'
+
+_lock = threading.Lock()
+_phases = defaultdict(float)
+_counters = defaultdict(int)
+_histograms = dict()
+_start = time.time()
+### ###
+
+logger = logging.getLogger('score')
+
+
+def add_time(phase, seconds):
+    with _lock:
+        _phases[phase] += seconds
+
+
+@contextmanager
+def timer(phase):
+    """Add the time spent in the with block to phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(phase, time.perf_counter() - start)
+
+
+def inc(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name, host, value, buckets=LATENCY_BUCKETS):
+    """Add value to the histogram name of host."""
+    with _lock:
+        key = (name, host)
+        if key not in _histograms:
+            _histograms[key] = {'buckets': list(buckets),
+                                'counts': [0] * (len(buckets) + 1),
+                                'sum': 0.0,
+                                'count': 0
+                                }
+        histogram = _histograms[key]
+
+        i = 0
+        while i < len(buckets) and value > buckets[i]:
+            i += 1
+        histogram['counts'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def peak_rss():
+    """Return the peak RSS (in bytes) of this process and of its children."""
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit)
+
+
+def snapshot():
+    """Return the metrics collected so far, as a dict."""
+    with _lock:
+        return {'phases': dict(_phases),
+                'counters': dict(_counters),
+                'histograms': [{'name': name,
+                                'host': host,
+                                'buckets': list(histogram['buckets']),
+                                'counts': list(histogram['counts']),
+                                'sum': histogram['sum'],
+                                'count': histogram['count']
+                                }
+                               for (name, host), histogram
+                               in sorted(_histograms.items())]
+                }
+
+
+def merge(other):
+    """Add the metrics of other, a snapshot() of another process."""
+    for phase, seconds in other['phases'].items():
+        add_time(phase, seconds)
+
+    for name, value in other['counters'].items():
+        inc(name, value)
+
+    with _lock:
+        for other_histogram in other['histograms']:
+            key = (other_histogram['name'], other_histogram['host'])
+            if key not in _histograms:
+                _histograms[key] = {'buckets': other_histogram['buckets'],
+                                    'counts': [0] * len(other_histogram['counts']),
+                                    'sum': 0.0,
+                                    'count': 0
+                                    }
+            histogram = _histograms[key]
+            histogram['counts'] = [count + other_count
+                                   for count, other_count
+                                   in zip(histogram['counts'],
+                                          other_histogram['counts'])]
+            histogram['sum'] += other_histogram['sum']
+            histogram['count'] += other_histogram['count']
+
+
+def reset():
+    global _start
+
+    with _lock:
+        _phases.clear()
+        _counters.clear()
+        _histograms.clear()
+        _start = time.time()
+
+
+def get_report(script, **info):
+    """Return the report of the run of script, with the additional info."""
+    report = snapshot()
+
+    self_rss, children_rss = peak_rss()
+    report.update({'script': script,
+                   'start': time.strftime('%Y-%m-%d %H:%M:%S',
+                                          time.gmtime(_start)),
+                   'wall_time': time.time() - _start,
+                   'peak_rss': self_rss,
+                   'peak_rss_children': children_rss
+                   })
+    report.update(info)
+
+    hits = report['counters'].get('cache_hits', 0)
+    misses = report['counters'].get('cache_misses', 0)
+    if hits + misses:
+        report['cache_hit_ratio'] = hits / (hits + misses)
+
+    return report
+
+
+def write_report(report, output):
+    logger.debug("Writing metrics: {}".format(output))
+    with codecs.open(output, 'w', 'utf-8') as f:
+        json.dump(report, f)
+
+
+def write_prometheus(report, output):
+    """Write report in the text format of Prometheus (e.g. for node_exporter).
+    """
+    script = report['script']
+    lines = []
+
+    def metric(name, metric_type, samples):
+        name = '{}_{}'.format(PROMETHEUS_PREFIX, name)
+        lines.append('# TYPE {} {}'.format(name, metric_type))
+        for labels, value in samples:
+            labels = dict(labels, script=script)
+            lines.append('{}{{{}}} {}'.format(
+                name,
+                ','.join('{}="{}"'.format(key, labels[key])
+                         for key in sorted(labels)),
+                value))
+
+    metric('wall_time_seconds', 'gauge', [({}, report['wall_time'])])
+    metric('phase_seconds', 'gauge',
+           [({'phase': phase}, seconds)
+            for phase, seconds in sorted(report['phases'].items())])
+    for name, value in sorted(report['counters'].items()):
+        metric('{}_total'.format(name), 'counter', [({}, value)])
+    if report['peak_rss'] is not None:
+        metric('peak_rss_bytes', 'gauge', [({}, report['peak_rss'])])
+
+    for histogram in report['histograms']:
+        name = '{}_{}'.format(PROMETHEUS_PREFIX, histogram['name'])
+        lines.append('# TYPE {} histogram'.format(name))
+        labels = 'host="{}",script="{}"'.format(histogram['host'], script)
+
+        cumulative = 0
+        bounds = [str(bound) for bound in histogram['buckets']] + ['+Inf']
+        for bound, count in zip(bounds, histogram['counts']):
+            cumulative += count
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels,
+                                                            bound,
+                                                            cumulative))
+        lines.append('{}_sum{{{}}} {}'.format(name, labels, histogram['sum']))
+        lines.append('{}_count{{{}}} {}'.format(name, labels,
+                                               histogram['count']))
+
+    logger.debug("Writing Prometheus metrics: {}".format(output))
+    with codecs.open(output, 'w', 'utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
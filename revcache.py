@@ -0,0 +1,656 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+revcache.py
+On-disk cache for the revisions requested by score.py.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+The cache is a SQLite database with one row for each (lang, book, page), so
+that single pages can be looked up and stored without reading or writing the
+whole cache.
+
+Pages can be stored either as the full response of the API or in a compact
+format, that keeps only what is needed to compute the scores: a list of
+[revid, timestamp, user id, quality level] for every revision, with the
+timestamp in seconds since the epoch and the user names stored once in a
+separate table.
+
+The cache also keeps, for every page and contest, the state of the scoring
+after the last revision seen, so that later runs need to score only the
+revisions made since then, and for every book and contest the time of the
+last run that scored all its pages, so that later runs need to request only
+the pages edited since then.
+
+A cache can also be a directory, see ShardedCache: every book is stored in a
+separate file, compressed with gzip, so that a process reads only the books it
+needs and more processes can share the same cache whatever books they score.
+open_cache() opens a directory as a ShardedCache and a file as a
+RevisionCache.
+
+Caches written by older versions of score.py (a single JSON file of the form
+{book: {page: data}}) can be imported with import_json_cache(), they are read
+one book at a time with iter_json_cache().
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import gzip
+import codecs
+import hashlib
+import logging
+import sqlite3
+import json as stdjson
+from collections import OrderedDict
+from urllib.parse import quote
+
+# Try to use yajl, a faster module for JSON
+# JSON caches are parsed incrementally with the standard module, since yajl
+# does not expose an incremental decoder.
+# import json
+try:
+    import yajl as json
+except ImportError:
+    import json
+
+
+logger = logging.getLogger('score')
+
+# time (in seconds) to wait for other processes writing to the cache
+TIMEOUT = 60
+# number of characters read at a time from JSON caches
+JSON_CHUNK_SIZE = 1024 * 1024
+# version of the layout of the directories of sharded caches
+SHARDS_VERSION = 1
+SHARDS_MANIFEST = 'manifest.json'
+SHARD_EXT = '.jsonl.gz'
+# longer file names of the shards are replaced by a hash of the book
+SHARD_NAME_MAX = 200
+# number of shards kept in memory by a ShardedCache
+SHARDS_OPEN = 8
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS revisions (
+    lang TEXT NOT NULL,
+    book TEXT NOT NULL,
+    page TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (lang, book, page)
+);
+CREATE TABLE IF NOT EXISTS compact_revisions (
+    lang TEXT NOT NULL,
+    book TEXT NOT NULL,
+    page TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (lang, book, page)
+);
+CREATE TABLE IF NOT EXISTS page_state (
+    lang TEXT NOT NULL,
+    book TEXT NOT NULL,
+    page TEXT NOT NULL,
+    contest TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (lang, book, page, contest)
+);
+CREATE TABLE IF NOT EXISTS book_checked (
+    lang TEXT NOT NULL,
+    book TEXT NOT NULL,
+    contest TEXT NOT NULL,
+    checked INTEGER NOT NULL,
+    PRIMARY KEY (lang, book, contest)
+);
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+'''
+
+
+class RevisionCache(object):
+    """Cache of the API responses for every page, keyed by (lang, book, page).
+
+    The database is opened lazily, at the first lookup or write.
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self._conn = None
+        self._user_ids = None
+        self._user_names = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            logger.debug("Opening cache: {}".format(self.cache_file))
+            self._conn = sqlite3.connect(self.cache_file, timeout=TIMEOUT)
+            # every page is committed as soon as it is fetched, WAL keeps
+            # these small transactions cheap.
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._conn.commit()
+
+        return self._conn
+
+    def get(self, lang, book, page):
+        row = self.conn.execute(
+            'SELECT data FROM revisions WHERE lang=? AND book=? AND page=?',
+            (lang, book, str(page))
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def put(self, lang, book, page, data, commit=True):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO revisions (lang, book, page, data) '
+            'VALUES (?, ?, ?, ?)',
+            (lang, book, str(page), json.dumps(data))
+            )
+
+        if commit:
+            self.conn.commit()
+
+    def _load_users(self):
+        if self._user_ids is None:
+            self._user_ids = dict()
+            self._user_names = dict()
+            for uid, name in self.conn.execute('SELECT id, name FROM users'):
+                self._user_ids[name] = uid
+                self._user_names[uid] = name
+
+    def get_user_id(self, name):
+        self._load_users()
+
+        if name not in self._user_ids:
+            # the user may have been added by another process sharing the
+            # cache
+            self.conn.execute('INSERT OR IGNORE INTO users (name) VALUES (?)',
+                              (name, ))
+            uid, = self.conn.execute('SELECT id FROM users WHERE name=?',
+                                     (name, )).fetchone()
+            self._user_ids[name] = uid
+            self._user_names[uid] = name
+
+        return self._user_ids[name]
+
+    def get_user_name(self, uid):
+        self._load_users()
+
+        if uid not in self._user_names:
+            name, = self.conn.execute('SELECT name FROM users WHERE id=?',
+                                      (uid, )).fetchone()
+            self._user_ids[name] = uid
+            self._user_names[uid] = name
+
+        return self._user_names[uid]
+
+    def get_compact(self, lang, book, page):
+        """Return the list of (revid, timestamp, user, quality) of a page.
+
+        Returns None if the page is not cached in the compact format.
+        """
+        row = self.conn.execute(
+            'SELECT data FROM compact_revisions '
+            'WHERE lang=? AND book=? AND page=?',
+            (lang, book, str(page))
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        get_user_name = self.get_user_name
+        return [(revid, timestamp, get_user_name(uid), quality)
+                for revid, timestamp, uid, quality in json.loads(row[0])]
+
+    def put_compact(self, lang, book, page, revisions, commit=True):
+        """Store the list of (revid, timestamp, user, quality) of a page."""
+        data = [(revid, timestamp, self.get_user_id(user), quality)
+                for revid, timestamp, user, quality in revisions]
+
+        self.conn.execute(
+            'INSERT OR REPLACE INTO compact_revisions '
+            '(lang, book, page, data) VALUES (?, ?, ?, ?)',
+            (lang, book, str(page), json.dumps(data))
+            )
+
+        if commit:
+            self.conn.commit()
+
+    def get_state(self, lang, book, page, contest):
+        """Return the scoring state of a page for contest, or None."""
+        row = self.conn.execute(
+            'SELECT data FROM page_state '
+            'WHERE lang=? AND book=? AND page=? AND contest=?',
+            (lang, book, str(page), contest)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return json.loads(row[0])
+
+    def put_state(self, lang, book, page, contest, state, commit=True):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO page_state '
+            '(lang, book, page, contest, data) VALUES (?, ?, ?, ?, ?)',
+            (lang, book, str(page), contest, json.dumps(state))
+            )
+
+        if commit:
+            self.conn.commit()
+
+    def get_checked(self, lang, book, contest):
+        """Return the time the pages of book were last scored for contest.
+
+        The time is in seconds since the epoch, None if it is not known.
+        """
+        row = self.conn.execute(
+            'SELECT checked FROM book_checked '
+            'WHERE lang=? AND book=? AND contest=?',
+            (lang, book, contest)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0]
+
+    def put_checked(self, lang, book, contest, checked, commit=True):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO book_checked '
+            '(lang, book, contest, checked) VALUES (?, ?, ?, ?)',
+            (lang, book, contest, checked)
+            )
+
+        if commit:
+            self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def iter_revisions(self):
+        """Iterate over the (lang, book, page, data) of the cache.
+
+        Pages are grouped by book (like the other iter_* methods), so that
+        they can be copied book by book, e.g. to a ShardedCache.
+        """
+        return self.conn.execute(
+            'SELECT lang, book, page, data FROM revisions '
+            'ORDER BY lang, book')
+
+    def iter_compact(self):
+        """Iterate over the (lang, book, page, revisions) of the cache."""
+        get_user_name = self.get_user_name
+        for lang, book, page, data in self.conn.execute(
+                'SELECT lang, book, page, data FROM compact_revisions '
+                'ORDER BY lang, book'):
+            yield lang, book, page, \
+                [(revid, timestamp, get_user_name(uid), quality)
+                 for revid, timestamp, uid, quality in json.loads(data)]
+
+    def iter_states(self):
+        """Iterate over the (lang, book, page, contest, state) of the cache."""
+        for lang, book, page, contest, data in self.conn.execute(
+                'SELECT lang, book, page, contest, data FROM page_state '
+                'ORDER BY lang, book'):
+            yield lang, book, page, contest, json.loads(data)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+            self._user_ids = None
+            self._user_names = None
+
+
+class ShardedCache(object):
+    """Cache of the pages in a directory, with a file for every book.
+
+    The pages of a book are stored in {cache_dir}/{lang}/{book}.jsonl.gz, as
+    lines of JSON ([kind, page, data], [kind, page, contest, data] for states
+    or [kind, contest, checked] for the time the book was last scored). A
+    shard is read in full the first time one of its pages is looked up, at
+    most SHARDS_OPEN shards are kept in memory; storing a page does not read
+    its shard. The pages stored are appended to the shard, as a separate gzip
+    member, when the cache is committed or a page of another book is looked
+    up (pages are requested book by book), with a single write, so that more
+    processes can append to the same shard. When a page is stored more than
+    once, the last line is the one that counts.
+
+    Every member starts with a line {"lang": lang, "book": book}, since the
+    name of the file may be a hash of the book. The manifest, manifest.json,
+    records the version of the layout.
+
+    It has the same methods of RevisionCache.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        # (lang, book) -> {kind: {key: data}}, the least recently used first
+        self._shards = OrderedDict()
+        # (lang, book) -> lines to append to the shard
+        self._pending = dict()
+
+        manifest_file = os.path.join(cache_dir, SHARDS_MANIFEST)
+        if os.path.exists(manifest_file):
+            with codecs.open(manifest_file, 'r', 'utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != SHARDS_VERSION:
+                raise ValueError("Unsupported version of the cache {}: {}"
+                                 .format(cache_dir, manifest.get('version')))
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            with codecs.open(manifest_file, 'w', 'utf-8') as f:
+                json.dump({'version': SHARDS_VERSION,
+                           'format': 'jsonl',
+                           'compression': 'gzip'
+                           }, f)
+
+    def shard_file(self, lang, book):
+        name = quote(book, safe=' ')
+        if len(name) > SHARD_NAME_MAX:
+            name = hashlib.sha1(book.encode('utf-8')).hexdigest()
+
+        return os.path.join(self.cache_dir, quote(lang, safe='') or '_',
+                            name + SHARD_EXT)
+
+    @staticmethod
+    def _read_shard(shard_file):
+        """Yield the lines of JSON of a shard, except the headers.
+
+        A member cut short by a process that crashed while writing it ends
+        the shard.
+        """
+        try:
+            with gzip.open(shard_file, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if isinstance(entry, list):
+                        yield entry
+        except FileNotFoundError:
+            return
+        except (EOFError, OSError) as err:
+            logger.warning("Shard {} is truncated: {}"
+                           .format(shard_file, err))
+
+    def _shard(self, lang, book):
+        key = (lang, book)
+        for other in [other for other in self._pending if other != key]:
+            self._flush(other)
+
+        shard = self._shards.pop(key, None)
+        if shard is None:
+            if len(self._shards) >= SHARDS_OPEN:
+                self._shards.popitem(last=False)
+            # the pages stored while the shard was not in memory
+            self._flush(key)
+            shard = self._load(self.shard_file(lang, book))
+
+        self._shards[key] = shard
+
+        return shard
+
+    def _load(self, shard_file):
+        """Return the pages of a shard, as a dict kind -> {key: data}."""
+        logger.debug("Reading shard: {}".format(shard_file))
+
+        shard = {'r': dict(), 'c': dict(), 's': dict(), 'k': dict()}
+        for entry in self._read_shard(shard_file):
+            if entry[0] == 's':
+                shard['s'][(entry[1], entry[2])] = entry[3]
+            else:
+                shard[entry[0]][entry[1]] = entry[2]
+
+        return shard
+
+    def _put(self, lang, book, kind, key, data):
+        """Store data, the shard is updated only if it is in memory."""
+        shard = self._shards.get((lang, book))
+        if shard is not None:
+            shard[kind][key] = data
+
+        if kind == 's':
+            entry = [kind, key[0], key[1], data]
+        else:
+            entry = [kind, key, data]
+        self._pending.setdefault((lang, book), []).append(json.dumps(entry))
+
+    def _flush(self, key):
+        lines = self._pending.pop(key, None)
+        if not lines:
+            return
+
+        lang, book = key
+        lines.insert(0, json.dumps({'lang': lang, 'book': book}))
+        data = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+
+        shard_file = self.shard_file(lang, book)
+        os.makedirs(os.path.dirname(shard_file), exist_ok=True)
+        fd = os.open(shard_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+    def get(self, lang, book, page):
+        return self._shard(lang, book)['r'].get(str(page))
+
+    def put(self, lang, book, page, data, commit=True):
+        # commit is accepted for compatibility with RevisionCache, pages are
+        # written book by book
+        self._put(lang, book, 'r', str(page), data)
+
+    def get_compact(self, lang, book, page):
+        """Return the list of (revid, timestamp, user, quality) of a page.
+
+        Returns None if the page is not cached in the compact format.
+        """
+        revisions = self._shard(lang, book)['c'].get(str(page))
+        if revisions is None:
+            return None
+
+        return [tuple(rev) for rev in revisions]
+
+    def put_compact(self, lang, book, page, revisions, commit=True):
+        """Store the list of (revid, timestamp, user, quality) of a page."""
+        self._put(lang, book, 'c', str(page),
+                  [list(rev) for rev in revisions])
+
+    def get_state(self, lang, book, page, contest):
+        """Return the scoring state of a page for contest, or None."""
+        return self._shard(lang, book)['s'].get((str(page), contest))
+
+    def put_state(self, lang, book, page, contest, state, commit=True):
+        self._put(lang, book, 's', (str(page), contest), state)
+
+    def get_checked(self, lang, book, contest):
+        """Return the time the pages of book were last scored for contest.
+
+        The time is in seconds since the epoch, None if it is not known.
+        """
+        return self._shard(lang, book)['k'].get(contest)
+
+    def put_checked(self, lang, book, contest, checked, commit=True):
+        self._put(lang, book, 'k', contest, checked)
+
+    def commit(self):
+        for key in list(self._pending):
+            self._flush(key)
+
+    def _iter_shards(self):
+        """Iterate over the (lang, book, shard) of the cache."""
+        self.commit()
+
+        for lang_dir in sorted(os.listdir(self.cache_dir)):
+            lang_path = os.path.join(self.cache_dir, lang_dir)
+            if not os.path.isdir(lang_path):
+                continue
+
+            for name in sorted(os.listdir(lang_path)):
+                if not name.endswith(SHARD_EXT):
+                    continue
+
+                shard_file = os.path.join(lang_path, name)
+                with gzip.open(shard_file, 'rt', encoding='utf-8') as f:
+                    header = json.loads(f.readline())
+
+                yield header['lang'], header['book'], self._load(shard_file)
+
+    def iter_revisions(self):
+        """Iterate over the (lang, book, page, data) of the cache."""
+        for lang, book, shard in self._iter_shards():
+            for page, data in shard['r'].items():
+                yield lang, book, page, json.dumps(data)
+
+    def iter_compact(self):
+        """Iterate over the (lang, book, page, revisions) of the cache."""
+        for lang, book, shard in self._iter_shards():
+            for page, revisions in shard['c'].items():
+                yield lang, book, page, [tuple(rev) for rev in revisions]
+
+    def iter_states(self):
+        """Iterate over the (lang, book, page, contest, state) of the cache."""
+        for lang, book, shard in self._iter_shards():
+            for (page, contest), state in shard['s'].items():
+                yield lang, book, page, contest, state
+
+    def close(self):
+        self.commit()
+        self._shards = OrderedDict()
+
+
+def open_cache(cache):
+    """Open cache, a ShardedCache if it is a directory, else a RevisionCache.
+    """
+    if os.path.isdir(cache):
+        return ShardedCache(cache)
+
+    return RevisionCache(cache)
+
+
+def iter_json_cache(json_file, chunk_size=JSON_CHUNK_SIZE):
+    """Iterate over the (book, pages) of a legacy JSON cache.
+
+    The file is parsed incrementally, only one book at a time is kept in
+    memory.
+    """
+    decoder = stdjson.JSONDecoder()
+
+    with codecs.open(json_file, 'r', 'utf-8') as f:
+        buf = f.read(chunk_size)
+        pos = 0
+
+        def skip(pos, chars):
+            nonlocal buf
+            while True:
+                while pos < len(buf) and buf[pos].isspace():
+                    pos += 1
+                if pos < len(buf):
+                    break
+                more = f.read(chunk_size)
+                if not more:
+                    raise ValueError("Unexpected end of file: {}"
+                                     .format(json_file))
+                buf = more
+                pos = 0
+
+            if buf[pos] not in chars:
+                raise ValueError("Unexpected '{}' in {}"
+                                 .format(buf[pos], json_file))
+            return pos
+
+        def decode(pos):
+            nonlocal buf
+            # the value may end beyond the text read so far, read twice as
+            # much until it can be decoded
+            size = chunk_size
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    more = f.read(max(size, len(buf) - pos))
+                    if not more:
+                        raise
+                    buf = buf[pos:] + more
+                    pos = 0
+                    size *= 2
+                else:
+                    return value, end
+
+        pos = skip(pos, '{') + 1
+        pos = skip(pos, '}"')
+        if buf[pos] == '}':
+            return
+
+        while True:
+            book, pos = decode(pos)
+            pos = skip(pos, ':') + 1
+            pos = skip(pos, '{[0123456789-"tfn')
+            pages, pos = decode(pos)
+
+            yield book, pages
+
+            # drop what has been decoded already
+            buf = buf[pos:]
+            pos = skip(0, ',}')
+            if buf[pos] == '}':
+                return
+            pos = skip(pos + 1, '"')
+
+
+def import_json_cache(json_file, cache, lang):
+    """Import a legacy JSON cache ({book: {page: data}}) into cache.
+
+    Legacy caches do not record the language of the Wikisource they were
+    built from, so all their entries are stored under lang.
+    """
+    logger.info("Importing JSON cache: {}".format(json_file))
+
+    count = 0
+    for book, pages in iter_json_cache(json_file):
+        # the booklist cache used to be stored in the same file
+        if book == 'CACHE_BOOKS_LIST':
+            continue
+
+        for page, data in pages.items():
+            cache.put(lang, book, page, data, commit=False)
+            count += 1
+
+        cache.commit()
+
+    logger.info("Imported {} pages".format(count))
+
+    return count
@@ -10,27 +10,67 @@ This script is part of wscontest-votecounter.
 
 ---
 usage:
-    score.py [-dv] [--booklist-cache BOOKLIST_CACHE] [--cache CACHE_FILE]
-             [--config CONFIG_FILE] [--enable-cache] [-f BOOKS_FILE]
-             [-o OUTPUT_TSV]
+    score.py [-dv] [--batch] [--booklist-cache BOOKLIST_CACHE]
+             [--cache CACHE_FILE] [--cache-dir CACHE_DIR] [--compact-cache]
+             [--concurrency N] [--config CONFIG_FILE] [--dump DUMP_FILE]
+             [--dump-namespace NS] [--enable-cache] [--existing]
+             [--import-cache JSON_CACHE] [--incremental] [-f BOOKS_FILE]
+             [--journal JOURNAL_FILE] [--metrics-output METRICS_FILE]
+             [-o OUTPUT_TSV] [--prometheus PROM_FILE] [--resume] [--touched]
+             [--window] [--workers N]
     score.py ( -h | --help )
 
 Count proofread and validated pages for the Wikisource contest.
 
 Optionals:
   -h, --help            show this help message and exit
+  --batch               Request the pages in batches of 50 titles
   --booklist-cache BOOKLIST_CACHE
                         JSON file to read and store the booklist cache
                         (default: {BOOKS_FILE}.booklist_cache.json)
-  --cache CACHE_FILE    JSON file to read and store the cache (default:
-                        {BOOKS_FILE}.cache.json)
+  --cache CACHE_FILE    SQLite file to read and store the cache (default:
+                        {BOOKS_FILE}.cache.db)
+  --cache-dir CACHE_DIR
+                        Directory of a cache with a file for every book,
+                        instead of --cache (implies --enable-cache)
+  --compact-cache       Store in the cache only the data needed to compute
+                        the scores
+  --concurrency N       Number of concurrent requests to the Wikisource API
+                        (default: 1)
   --config CONFIG_FILE  INI file to read configs (default: contest.conf.ini)
   -d --debug            Enable debug output (implies -v)
+  --dump DUMP_FILE      Read the pages from a XML history dump, compressed or
+                        not, can be repeated (implies --enable-cache)
+  --dump-namespace NS   Number of the Page namespace in the dumps (default:
+                        any)
   --enable-cache        Enable caching
+  --existing            Request only the pages that exist and were edited
+                        since the start of the contest
+  --import-cache JSON_CACHE
+                        Import a JSON cache written by older versions of this
+                        script (implies --enable-cache)
+  --incremental         Score only the revisions made since the last run
+                        (implies --enable-cache)
   -f BOOKS_FILE         TSV file with the books to be processed (default:
                         books.tsv)
+  --journal JOURNAL_FILE
+                        File to record the books scored, to resume the run
+                        (default: {OUTPUT_TSV}.journal)
+  --metrics-output METRICS_FILE
+                        JSON file to write the metrics of the run (default:
+                        {OUTPUT_TSV}.metrics.json)
   -o OUTPUT_TSV         Output file (default: {BOOKS_FILE}.results.tsv)
+  --prometheus PROM_FILE
+                        Also write the metrics of the run in the Prometheus
+                        text format
+  --resume              Resume a run that did not complete, without scoring
+                        again the books in the journal
+  --touched             Request only the pages edited during the contest
   -v --verbose          Enable verbose output
+  --window              Request only the revisions made around the contest
+                        dates
+  --workers N           Number of worker processes scoring books at the same
+                        time (default: 1)
 
 ---
 The MIT License (MIT)
@@ -65,20 +105,31 @@ THE SOFTWARE.
 
 import os
 import re
+import io
 import csv
 import time
 import codecs
+import calendar
 import logging
 import argparse
 import configparser
+from collections import deque
+from collections import OrderedDict
 from collections import defaultdict
 from collections import namedtuple
 from collections import Counter
-from functools import reduce
-from operator import add
+from functools import lru_cache
+from bisect import bisect_right
 from datetime import datetime
-import urllib.parse
-import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import wsapi
+import dumps
+import metrics
+from revcache import ShardedCache, open_cache, import_json_cache
+from scoring import SCORE_FIELDS, NO_QUALITY, GAIN, CASES, POINTS
+from scoring import score_transitions, ScoreTable
 
 # Try to use yajl, a faster module for JSON
 # import json
@@ -90,10 +141,12 @@ except ImportError:
 ### GLOBALS AND DEFAULTS ###
 # Files
 BOOKS_FILE = "books.tsv"
-CACHE_FILE = "{BOOKS_FILE}.cache.json"
+CACHE_FILE = "{BOOKS_FILE}.cache.db"
 BOOKLIST_CACHE_FILE = "{BOOKS_FILE}.booklist_cache.json"
 CONFIG_FILE = "contest.conf.ini"
 OUTPUT_TSV = '{BOOKS_FILE}.results.tsv'
+METRICS_OUTPUT = '{OUTPUT_TSV}.metrics.json'
+JOURNAL_FILE = '{OUTPUT_TSV}.journal'
 
 # URLs
 WIKISOURCE_API = 'https://{lang}.wikisource.org/w/api.php'
@@ -104,9 +157,36 @@ OLDWIKISOURCE_PREFIXES = set(['old', 'oldwikisource', 'www', ''])
 
 # params
 MAX_RETRIES = 10
-
-#SAL:
-SAL = {0: 0, 25: 1, 50: 2, 75: 3, 100: 4}
+# number of concurrent requests to the Wikisource API
+CONCURRENCY = 1
+# number of pages requested ahead of scoring, for each concurrent request
+PREFETCH_FACTOR = 4
+# number of worker processes scoring books at the same time
+WORKERS = 1
+# books with more pages are split in ranges of pages between the workers
+UNIT_PAGES = 100
+# with debug, number of rows of debug/points buffered in memory
+USER_LOG_ROWS = 10000
+# with debug, number of files of debug/points kept open at the same time
+USER_LOG_FILES = 64
+# maximum number of titles in a single API request
+BATCH_SIZE = 50
+# maximum number of revisions with content in a single API request
+RVLIMIT = 50
+# number of pages read from XML dumps stored in the cache in a transaction
+DUMP_COMMIT_EVERY = 1000
+# recent changes older than this (in seconds) are not kept by the wikis
+RC_MAX_AGE = 30 * 24 * 3600
+# edits can reach the recent changes with this delay (in seconds), they are
+# listed from this much before the last run
+RC_DELAY = 60
+
+# quality level of a page, from the header of its text
+PAGEQUALITY_RE = re.compile('<pagequality level="(\\d)" user="(.*?)" />')
+PAGEQUALITY_HEADER_RE = re.compile('<noinclude><pagequality level="(\\d)" user="(.*?)" />')
+
+# a revision of a page, as used to compute the scores
+Revision = namedtuple('Revision', ['revid', 'timestamp', 'user', 'quality'])
 
 ### ###
 
@@ -136,6 +216,10 @@ logger = logging.getLogger('score')
 logger.setLevel(lvl_logger)
 ###
 
+def format_timestamp(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
 def make_debug_dir():
     try:
         os.makedirs(os.path.join('debug','revisions'))
@@ -159,37 +243,76 @@ def read_cache(cache_file):
     except IOError:
         cache = dict()
 
+    # a cache left partly written (e.g. by an interrupted run) is ignored
+    except ValueError:
+        logger.warning("Could not read the cache {}, ignoring it"
+                       .format(cache_file))
+        cache = dict()
+
     return cache
 
 
 def write_cache(cache, cache_file):
+    """Write cache to cache_file as JSON.
+
+    The cache is written to a temporary file that then replaces cache_file,
+    so that processes sharing cache_file never read it partly written.
+    """
     logger.debug("Writing cache: {}".format(cache_file))
-    with codecs.open(cache_file, 'w', 'utf-8') as f:
-        json.dump(cache, f)
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with codecs.open(tmp_file, 'w', 'utf-8') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
 
+def get_numpages(books):
+    """Request the number of pages of the files of books to Commons.
 
-def get_numpages(book):
+    Returns a dict book -> number of pages, books whose number of pages could
+    not be retrieved are missing from the dict.
+    """
+    titles = dict(('File:{book}'.format(book=book), book) for book in books)
 
     params = {
         'action': 'query',
         'format': 'json',
         'prop': 'imageinfo',
-        'titles': 'File:{book}'.format(book=book),
-        'iilimit': '50',
+        'titles': '|'.join(titles),
         'iiprop': 'size'
     }
 
-    params = urllib.parse.urlencode(params).encode('ascii')
-    logger.info("\tRequest image info for file 'File:{book}'".format(book=book))
+    logger.info("\tRequest image info for {} files".format(len(books)))
 
-    with urllib.request.urlopen(COMMONS_API, params) as f:
-        data = json.loads(f.read().decode('utf-8'))
-        numpages = list(data['query']['pages'].values())[0]['imageinfo'][0]['pagecount']
+    try:
+        data = wsapi.api_request_retry(COMMONS_API,
+                                       params,
+                                       max_retries=MAX_RETRIES)
+    except wsapi.RequestFailed as err:
+        logger.error(err)
+        return dict()
+    query = data.get('query', {})
+
+    normalized = dict((norm['to'], norm['from'])
+                      for norm in query.get('normalized', []))
+
+    numpages = dict()
+    for page_data in query.get('pages', {}).values():
+        title = page_data.get('title')
+        book = titles.get(normalized.get(title, title))
+        try:
+            numpages[book] = int(page_data['imageinfo'][0]['pagecount'])
+        except (KeyError, IndexError, TypeError, ValueError):
+            continue
 
-        return int(numpages)
+    return numpages
 
 
-def get_books(books_file, booklist_cache):
+def get_books(books_file, booklist_cache, concurrency=CONCURRENCY):
 
     booklist = 'CACHE_BOOKS_LIST'
     cache = read_cache(booklist_cache)
@@ -202,31 +325,175 @@ def get_books(books_file, booklist_cache):
         clean_lines = [line.strip().strip('\"') for line in lines
                        if line.strip() and (not line.startswith("#"))]
 
-    for book in clean_lines:
+    missing = [book for book in clean_lines if book not in cache[booklist]]
+    batches = [missing[i:i+BATCH_SIZE]
+               for i in range(0, len(missing), BATCH_SIZE)]
+
+    wsapi.set_host_limit(COMMONS_API, concurrency)
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        for numpages in executor.map(get_numpages, batches):
+            cache[booklist].update(numpages)
+
+    for book in missing:
         if book not in cache[booklist]:
-            end = get_numpages(book)
-            cache[booklist][book] = end
+            logger.error("Could not get the number of pages of 'File:{}', "
+                         "skipping it".format(book))
+
+    if any(book in cache[booklist] for book in missing):
+        # other processes may have added their books in the meantime
+        current = read_cache(booklist_cache)
+        current.setdefault(booklist, dict()).update(cache[booklist])
+        write_cache(current, booklist_cache)
+
+    # the cache may be shared with other lists of books: the books are
+    # returned in the order of books_file, since the totals depend on it
+    # (see sum_scores())
+    books = OrderedDict()
+    for book in clean_lines:
+        if book in cache[booklist]:
+            books[book] = cache[booklist][book]
+    return list(books.items())
 
-            write_cache(cache, booklist_cache)
 
-    return [(book, end) for book, end in cache[booklist].items()]
+def get_wikisource_api(lang):
+    if lang in OLDWIKISOURCE_PREFIXES:
+        return OLDWIKISOURCE_API
+    else:
+        return WIKISOURCE_API.format(lang=lang)
 
 
-def get_page_revisions(book, page, lang, enable_cache, cache_file):
+def format_api_timestamp(timestamp):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
 
-    cache = None
-    if enable_cache:
-        cache = read_cache(cache_file)
 
-    page = str(page)
-    # Request is cached
-    if enable_cache and (book in cache) and (page in cache[book]):
-        logger.info("Request is cached...")
-        return cache[book][page]
+def fetch_window_revisions(book, page, lang, window):
+    """Request the revisions of a page made around the contest window.
+
+    window is a tuple (start, end) of timestamps in seconds since the epoch.
+    The revisions from start to end are requested following the
+    continuation of the responses, together with the last revision before
+    start (which gives the quality level of the page when the contest
+    started) and the first revision after end (which can revert a revision
+    made during the contest).
+
+    Returns the data in the same format returned by fetch_page_revisions().
+    """
+    start, end = window
+    title = 'Page:{book}/{page}'.format(book=book, page=page)
+    wikisource_api = get_wikisource_api(lang)
+
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'revisions',
+        'titles': title,
+        'rvlimit': RVLIMIT,
+        'rvdir': 'newer',
+        'rvstart': format_api_timestamp(start),
+        'rvprop': 'ids|user|timestamp|content'
+    }
+    logger.info("\tRequest page '{title}' from {start}"
+                .format(title=title, start=params['rvstart']))
+
+    end = format_api_timestamp(end)
+
+    result = None
+    revisions = []
+    for data in wsapi.iter_query(wikisource_api, params, MAX_RETRIES):
+        try:
+            page_data = list(data['query']['pages'].values())[0]
+        except (KeyError, IndexError):
+            return data
+
+        if result is None:
+            result = data
 
-    # Request is NOT cached
-    if enable_cache and book not in cache:
-        cache[book] = dict()
+        # timestamps in the ISO 8601 format can be compared as strings
+        after_end = False
+        for rev in page_data.get('revisions', []):
+            revisions.append(rev)
+            if rev['timestamp'] > end:
+                after_end = True
+                break
+
+        if after_end:
+            break
+
+    if 'missing' in page_data:
+        return result
+
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'revisions',
+        'titles': title,
+        'rvlimit': 1,
+        'rvdir': 'older',
+        'rvstart': format_api_timestamp(start - 1),
+        'rvprop': 'ids|user|timestamp|content'
+    }
+    data = wsapi.api_request_retry(wikisource_api,
+                                   params,
+                                   max_retries=MAX_RETRIES)
+    try:
+        revisions[0:0] = list(data['query']['pages'].values())[0]['revisions']
+    except (KeyError, IndexError):
+        pass
+
+    # revisions are returned by the API from the newest to the oldest
+    page_data = list(result['query']['pages'].values())[0]
+    page_data['revisions'] = revisions[::-1]
+    result.pop('continue', None)
+
+    return result
+
+
+def fetch_new_revisions(book, page, lang, revid):
+    """Request the revisions of a page starting from revision revid.
+
+    Returns the data in the same format returned by fetch_page_revisions().
+    """
+    title = 'Page:{book}/{page}'.format(book=book, page=page)
+
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'revisions',
+        'titles': title,
+        'rvlimit': RVLIMIT,
+        'rvdir': 'newer',
+        'rvstartid': revid,
+        'rvprop': 'ids|user|timestamp|content'
+    }
+    logger.info("\tRequest page '{title}' from revision {revid}"
+                .format(title=title, revid=revid))
+
+    wikisource_api = get_wikisource_api(lang)
+
+    result = None
+    revisions = []
+    for data in wsapi.iter_query(wikisource_api, params, MAX_RETRIES):
+        try:
+            page_data = list(data['query']['pages'].values())[0]
+        except (KeyError, IndexError):
+            return data
+
+        if result is None:
+            result = data
+        revisions.extend(page_data.get('revisions', []))
+
+    # revisions are returned by the API from the newest to the oldest
+    page_data = list(result['query']['pages'].values())[0]
+    page_data['revisions'] = revisions[::-1]
+    result.pop('continue', None)
+
+    return result
+
+
+def fetch_page_revisions(book, page, lang, window=None):
+
+    if window is not None:
+        return fetch_window_revisions(book, page, lang, window)
 
     params = {
         'action': 'query',
@@ -234,326 +501,947 @@ def get_page_revisions(book, page, lang, enable_cache, cache_file):
         'prop': 'revisions',
         'titles': 'Page:{book}/{page}'.format(book=book, page=page),
         'rvlimit': '50',
-        'rvprop': 'user|timestamp|content'
+        'rvprop': 'ids|user|timestamp|content'
     }
-    params = urllib.parse.urlencode(params).encode('ascii')
     logger.info("\tRequest page 'Page:{book}/{page}'".format(book=book, page=page))
 
-    retries_counter = 0
-    retry_fetch = True
-    data = {}
+    return wsapi.api_request_retry(get_wikisource_api(lang),
+                                   params,
+                                   max_retries=MAX_RETRIES)
 
-    if lang in OLDWIKISOURCE_PREFIXES:
-        wikisource_api = OLDWIKISOURCE_API
-    else:
-        wikisource_api = WIKISOURCE_API.format(lang=lang)
 
-    while retry_fetch and retries_counter < MAX_RETRIES:
-        try:
-            f = urllib.request.urlopen(wikisource_api, params)
-            data = json.loads(f.read().decode('utf-8'))
-            retry_fetch = False
-        except:
-            time.sleep(0.5)
-            retries_counter += 1
-            retry_fetch = True
-
-    if enable_cache:
-        cache[book][page] = data
-        write_cache(cache, cache_file)
-        return cache[book][page]
+def get_page_namespace(lang):
+    """Return the number of the Page namespace of the Wikisource of lang.
+
+    Returns None if the wiki has no Page namespace.
+    """
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'meta': 'siteinfo',
+        'siprop': 'namespaces'
+    }
+    data = wsapi.api_request_retry(get_wikisource_api(lang),
+                                   params,
+                                   max_retries=MAX_RETRIES)
+
+    for namespace in data.get('query', {}).get('namespaces', {}).values():
+        if namespace.get('canonical') == 'Page':
+            return namespace['id']
+
+    return None
+
+
+def iter_edited_titles(lang, namespace, start, end):
+    """Yield the titles of the pages of namespace edited from start to end.
+
+    start and end are timestamps in seconds since the epoch. The edits are
+    listed with list=recentchanges, or with list=allrevisions if start is
+    older than the recent changes kept by the wiki. Titles can be repeated.
+    """
+    if start >= time.time() - RC_MAX_AGE:
+        params = {
+            'action': 'query',
+            'format': 'json',
+            'list': 'recentchanges',
+            'rcnamespace': namespace,
+            'rcstart': format_api_timestamp(start),
+            'rcend': format_api_timestamp(end),
+            'rcdir': 'newer',
+            'rctype': 'edit|new',
+            'rcprop': 'title',
+            'rclimit': 'max'
+        }
+        key = 'recentchanges'
     else:
-        return data
+        params = {
+            'action': 'query',
+            'format': 'json',
+            'list': 'allrevisions',
+            'arvnamespace': namespace,
+            'arvstart': format_api_timestamp(start),
+            'arvend': format_api_timestamp(end),
+            'arvdir': 'newer',
+            'arvprop': 'ids',
+            'arvlimit': 'max'
+        }
+        key = 'allrevisions'
+
+    logger.info("Request the pages edited from {} to {} ({})"
+                .format(format_timestamp(start), format_timestamp(end), key))
+
+    wikisource_api = get_wikisource_api(lang)
+    for data in wsapi.iter_query(wikisource_api, params, MAX_RETRIES):
+        for change in data.get('query', {}).get(key, []):
+            yield change['title']
+
+
+def get_touched_pages(books, lang, start, end):
+    """Return the pages of books edited from start to end.
+
+    Returns a dict book -> set of pages, or None if the pages edited cannot
+    be listed. The other pages cannot give points in the contest: the points
+    are given for the revisions made during the contest and for the reverts
+    of those revisions.
+    """
+    namespace = get_page_namespace(lang)
+    if namespace is None:
+        logger.warning("No Page namespace on the Wikisource of '{}', all "
+                       "the pages will be requested".format(lang))
+        return None
+
+    touched = get_edited_pages(books, lang, namespace, start, end)
+
+    logger.info("{} of {} pages edited during the contest"
+                .format(sum(len(pages) for pages in touched.values()),
+                        sum(end for _, end in books)))
+
+    return touched
+
+
+def get_edited_pages(books, lang, namespace, start, end):
+    """Return the pages of books edited from start to end.
+
+    namespace is the Page namespace of the Wikisource of lang. Returns a dict
+    book -> set of pages, see iter_edited_titles().
+    """
+    names = dict((dumps.normalize_title(book), book) for book, _ in books)
+    numpages = dict(books)
+
+    edited = defaultdict(set)
+    for title in iter_edited_titles(lang, namespace, start, end):
+        match = dumps.match_page(title, namespace, names, namespace)
+        if match is not None and match[1] <= numpages[match[0]]:
+            edited[match[0]].add(match[1])
+
+    return dict(edited)
+
+
+def get_edited_since_checked(books, lang, cache_file, contest, now):
+    """Return the pages of books edited since they were scored for contest.
+
+    Only the books scored by a previous run are included (see
+    RevisionCache.get_checked()): returns a dict book -> set of pages edited
+    from the oldest of those runs to now, or None if no book has been scored
+    or the pages edited cannot be listed.
+    """
+    cache = open_cache(cache_file)
+    try:
+        checked = dict((book, cache.get_checked(lang, book, contest))
+                       for book, _ in books)
+    finally:
+        cache.close()
 
+    checked_books = [(book, end) for book, end in books
+                     if checked[book] is not None]
+    if not checked_books:
+        return None
 
-def write_user_log(**kwargs):
+    namespace = get_page_namespace(lang)
+    if namespace is None:
+        logger.warning("No Page namespace on the Wikisource of '{}', all "
+                       "the pages will be requested".format(lang))
+        return None
 
-    # Revision(page={page},user={user},"
-    #                              "quality={quality},old_user={old_user},"
-    #                              "old_quality={old_quality},"
-    #                              "timestamp={timestamp})"
+    start = min(checked[book] for book, _ in checked_books) - RC_DELAY
+    edited = get_edited_pages(checked_books, lang, namespace, start, now)
 
-    csv_fields = ['user', 'punts', 'vali', 'revi',
-                  'book', 'page',
-                  'quality', 'old_quality',
-                  'other_user', 'timestamp' ]
+    logger.info("{} pages of {} books edited since the last run"
+                .format(sum(len(pages) for pages in edited.values()),
+                        len(checked_books)))
 
-    user = kwargs['user']
-    filename = '{user}.points.tsv'.format(user=user)
-    output = os.path.join('debug', 'points', filename)
+    return dict((book, edited.get(book, set())) for book, _ in checked_books)
 
-    write_header = False
-    if not os.path.exists(output):
-        write_header = True
 
-    with open(output, 'a+', newline='') as csvfile:
-        writer = csv.DictWriter(csvfile,
-                                fieldnames=csv_fields,
-                                delimiter='\t',
-                                quoting=csv.QUOTE_MINIMAL)
+def iter_book_pages(book, lang, namespace):
+    """Yield (title, last edit) for the pages of book in namespace.
 
-        if write_header:
-            writer.writeheader()
-            write_header = False
+    The subpages of the book are listed with generator=allpages, BATCH_SIZE
+    at a time, together with their info and their last revision. The last
+    edit is the timestamp of the last revision in the format of the API, or
+    the time the page was last touched if the revision is not returned
+    (touched is never older than the last edit).
+    """
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'generator': 'allpages',
+        'gapnamespace': namespace,
+        'gapprefix': '{book}/'.format(book=book),
+        'gaplimit': BATCH_SIZE,
+        'prop': 'info|revisions',
+        'rvprop': 'timestamp'
+    }
+    logger.info("\tRequest the pages of '{book}'".format(book=book))
 
-        writer.writerow(kwargs)
+    wikisource_api = get_wikisource_api(lang)
+    for data in wsapi.iter_query(wikisource_api, params, MAX_RETRIES):
+        for page_data in data.get('query', {}).get('pages', {}).values():
+            if 'missing' in page_data or 'invalid' in page_data:
+                continue
+            revisions = page_data.get('revisions')
+            if revisions:
+                yield page_data['title'], revisions[0]['timestamp']
+            elif 'touched' in page_data:
+                yield page_data['title'], page_data['touched']
+
+
+def get_existing_pages(books, lang, start, concurrency=CONCURRENCY):
+    """Return the pages of books that exist and were edited since start.
+
+    Returns a dict book -> set of pages, like get_touched_pages(), or None
+    if the pages cannot be listed. The pages that do not exist and the pages
+    whose last edit is older than start cannot give points in the contest.
+    """
+    namespace = get_page_namespace(lang)
+    if namespace is None:
+        logger.warning("No Page namespace on the Wikisource of '{}', all "
+                       "the pages will be requested".format(lang))
+        return None
+
+    names = dict((dumps.normalize_title(book), book) for book, _ in books)
+    numpages = dict(books)
+    start = format_api_timestamp(start)
+
+    def book_pages(book):
+        return list(iter_book_pages(book, lang, namespace))
+
+    existing = dict()
+    total = 0
+    wsapi.set_host_limit(get_wikisource_api(lang), concurrency)
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        for (book, _), pages in zip(books, executor.map(book_pages,
+                                                        [book for book, _
+                                                         in books])):
+            existing[book] = set()
+            for title, last_edit in pages:
+                match = dumps.match_page(title, namespace, names, namespace)
+                if match is None or match[0] != book or \
+                        match[1] > numpages[book]:
+                    continue
+                total += 1
+                # timestamps in the ISO 8601 format can be compared as
+                # strings
+                if last_edit >= start:
+                    existing[book].add(match[1])
+
+    logger.info("{} of {} pages exist, {} edited since the start of the "
+                "contest".format(total,
+                                 sum(numpages.values()),
+                                 sum(len(pages) for pages in existing.values())))
+
+    return existing
+
+
+@lru_cache(maxsize=4096)
+def _date_timestamp(date):
+    return calendar.timegm((int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                            0, 0, 0))
+
+
+def parse_api_timestamp(timestamp):
+    """Convert a timestamp of the API (YYYY-MM-DDTHH:MM:SSZ) to an epoch."""
+    # revisions of the same day share the conversion of the date
+    return _date_timestamp(timestamp[0:10]) + \
+        int(timestamp[11:13]) * 3600 + \
+        int(timestamp[14:16]) * 60 + \
+        int(timestamp[17:19])
+
+
+def parse_quality(text):
+    # the header is usually at the very beginning of the page
+    match = PAGEQUALITY_HEADER_RE.match(text)
+    if match is None:
+        match = PAGEQUALITY_RE.search(text)
+        if match is None:
+            raise ValueError("No pagequality header found")
+
+    return int(match.group(1))
+
+
+def decode_revisions(data):
+    """Return the list of Revision of a page from the response of the API.
+
+    Revisions are returned in chronological order, with the timestamp in
+    seconds since the epoch. Returns an empty list for pages without
+    revisions (e.g. pages that do not exist).
+    """
+    try:
+        revs = list(data['query']['pages'].values())[0]['revisions']
+    except (KeyError, IndexError):
+        return []
+
+    with metrics.timer('decode'):
+        return [Revision(rev.get('revid'),
+                         parse_api_timestamp(rev['timestamp']),
+                         rev['user'],
+                         parse_quality(rev['*']))
+                for rev in reversed(revs)]
+
+
+def get_cached_revisions(book, page, lang, cache):
+    revisions = cache.get_compact(lang, book, page)
+    if revisions is not None:
+        metrics.inc('cache_hits')
+        return [Revision(*rev) for rev in revisions]
+
+    data = cache.get(lang, book, page)
+    if data is not None:
+        metrics.inc('cache_hits')
+        return decode_revisions(data)
+
+    metrics.inc('cache_misses')
+    return None
+
+
+def store_revisions(book, page, lang, cache, data, compact=False):
+    """Decode data and store it in the cache, return the decoded revisions.
+
+    With compact, only the decoded revisions are stored.
+    """
+    revisions = decode_revisions(data)
+
+    if cache is not None:
+        if compact:
+            cache.put_compact(lang, book, page, revisions)
+        else:
+            cache.put(lang, book, page, data)
+
+    return revisions
+
+
+def import_dump(dump_files, books, lang, cache, namespace=None):
+    """Store in cache the pages of books from the XML dumps dump_files.
+
+    Pages are stored in the compact format as they are read, committing every
+    DUMP_COMMIT_EVERY pages, so only the pages of a transaction are kept in
+    memory (a ShardedCache writes them book by book when they are
+    committed). A page found in more dumps is stored from the first one. The
+    pages of books that are not in the dumps (i.e. they did not exist) are
+    stored without revisions, so that none of the pages of books is requested
+    to the API.
+    """
+    numpages = dict(books)
+    found = set()
+    for dump_file in dump_files:
+        logger.info("Reading dump: {}".format(dump_file))
+
+        for book, page, data in dumps.iter_dump_pages(dump_file,
+                                                      numpages,
+                                                      namespace):
+            if page > numpages[book] or (book, page) in found:
+                continue
 
+            cache.put_compact(lang, book, page, decode_revisions(data),
+                              commit=False)
+            found.add((book, page))
+            if len(found) % DUMP_COMMIT_EVERY == 0:
+                cache.commit()
 
+    count = len(found)
+    for book, end in books:
+        for page in range(1, end + 1):
+            if (book, page) in found:
+                continue
 
-def get_score(books_file,
-              contest_start,
-              contest_end,
-              lang,
-              booklist_cache,
-              enable_cache,
-              cache_file,
-              debug=False):
-    # defaults are 0
-    books = get_books(books_file, booklist_cache)
-    tot_punts = dict()
-    tot_vali = dict()
-    tot_revi = dict()
-    tot_revi2 = dict()
-    tot_revi3 = dict()
-    tot_revi5 = dict()
-    
-    for i, (book, end) in enumerate(books):
-        logger.info("Processing book... \"{}\"".format(book))
+            cache.put_compact(lang, book, page, [], commit=False)
+            count += 1
+            if count % DUMP_COMMIT_EVERY == 0:
+                cache.commit()
+    cache.commit()
 
-        if debug:
-            make_debug_dir()
+    logger.info("Imported {} pages from the dumps".format(len(found)))
 
-            csv_fields = ['user', 'existing_user', 'quality', 'old_user',
-                          'old_quality', 'timestamp', 'page']
-            revisions_csvfilename = '{book}.revisions.csv'.format(book=book)
-            revisions_csv = os.path.join('debug', 'revisions',
-                                          revisions_csvfilename)
-            revisions_csvfile = open(revisions_csv, 'w')
-            writer = csv.DictWriter(revisions_csvfile,
-                                    fieldnames=csv_fields,
-                                    delimiter='\t',
-                                    quoting=csv.QUOTE_MINIMAL)
-            writer.writeheader()
+    return len(found)
 
-        punts = defaultdict(int)
-        vali = defaultdict(int)
-        revi = defaultdict(int)
-        revi2 = defaultdict(int)
-        revi3 = defaultdict(int)
-        revi5 = defaultdict(int)
 
-        logger.info("Querying the API...")
-        for pag in range(1, end + 1):
-            query = get_page_revisions(book,
-                                       pag,
-                                       lang,
-                                       enable_cache,
-                                       cache_file)
-            try:
-                revs = list(query['query']['pages'].values())[0]['revisions'][::-1]
-            except KeyError:
-                continue
+def get_page_revisions(book,
+                       page,
+                       lang,
+                       cache=None,
+                       compact=False,
+                       window=None):
 
-            page_userlist = defaultdict(int)
-            for rev in revs:
-                user = rev['user']
-                page_userlist[user]+=1
-
-            old = None
-            oldUser = None
-            oldTimestamp = None
-            existing_user = 'N'
-
-            # we do not need to check if the user that proofreads the page (SAL 75%)
-            # and the user that valides the page are the same.
-            # This is alreaady checked on Wikisource.
-            # proofreaderUser = None
-
-            for rev in revs:
-                timestamp = datetime.strptime(rev['timestamp'], '%Y-%m-%dT%H:%M:%SZ')
-                user = rev['user']
-                txt = rev['*']
-                quality_level, newUser = re.findall('<pagequality level="(\d)" user="(.*?)" />', txt)[0]
-                quality_level = int(quality_level)
-                newUser = user
-
-                if page_userlist[newUser]>1:
-                    if timestamp >= contest_start and timestamp < contest_end:
-                        existing_user = 'C'
-                    else:
-                        existing_user = 'D'
-                else:
-                    if timestamp >= contest_start and timestamp < contest_end:
-                        existing_user = 'P'
-                    else:
-                        existing_user = 'N'
-
-                if timestamp >= contest_start and timestamp < contest_end:
-                    logger.debug("Revision(page={page},user={user},"
-                                 "quality={quality},old_user={old_user},"
-                                 "old_quality={old_quality},"
-                                 "timestamp={timestamp})"
-                        .format(page=pag,user=newUser, quality=quality_level,
-                                old_user=oldUser, old_quality=old,
-                                timestamp=timestamp))
-                if debug:
-                    newUser_padded = "{: <25}".format(newUser or '')
-                    oldUser_padded = "{: <25}".format(oldUser or '')
-                    old_quality = 0 if old is None else old
-
-                    writer.writerow({'user': newUser_padded,
-                                     'existing_user': existing_user,
-                                     'quality': quality_level,
-                                     'old_user': oldUser_padded,
-                                     'old_quality': old_quality,
-                                     'timestamp': timestamp,
-                                     'page': pag,
-                                     })
+    page = str(page)
+    # Request is cached
+    if cache is not None:
+        revisions = get_cached_revisions(book, page, lang, cache)
+        if revisions is not None:
+            logger.info("Request is cached...")
+            return revisions
+
+    data = fetch_page_revisions(book, page, lang, window)
+
+    return store_revisions(book, page, lang, cache, data, compact)
+
+
+def fetch_batch_revisions(book, pages, lang, executor=None, window=None):
+    """Request the last revision of pages of book with multi-title queries.
 
-                # we do not need to check if proofreaderUser and Validetor
-                # are the same (see above)
-                # if quality_level == SAL[75] and (old is None or old < SAL[75]):
-                #     proofreaderUser = newUser
-
-                assigned_punts = 0
-                assigned_vali = 0
-                assigned_revi = 0
+    The API gives the full history only for single-title queries, but the
+    last revision is already the full history of the pages that have been
+    created and never edited afterwards (their last revision has no parent)
+    and missing pages have no history at all. The histories of these pages
+    are split from the combined response; the other pages are requested one
+    by one, submitting the requests to executor if given. A single page is
+    requested with fetch_page_revisions() only.
 
-                # if old is None: Page doesn't exist before
-                if quality_level == SAL[50] and (old is None or old < SAL[50]) \
-                        and timestamp >= contest_start \
-                        and timestamp < contest_end:
+    Returns a dict page -> data (or a Future that returns data), with data in
+    the same format returned by fetch_page_revisions().
+    """
+    # the combined response would only save the request of a page created
+    # and never edited
+    if len(pages) == 1:
+        return {pages[0]: fetch_page_revisions(book, pages[0], lang, window)}
 
-                        punts[newUser] += 2
-                        revi[newUser] += 1
-                        revi2[newUser] += 1
+    titles = dict(('Page:{book}/{page}'.format(book=book, page=page), page)
+                  for page in pages)
 
-                        assigned_punts = 2
-                        assigned_revi = 1
+    params = {
+        'action': 'query',
+        'format': 'json',
+        'prop': 'revisions',
+        'titles': '|'.join(titles),
+        'rvprop': 'ids|user|timestamp|content'
+    }
+    logger.info("\tRequest {num} pages of '{book}'"
+                .format(num=len(pages), book=book))
+
+    wikisource_api = get_wikisource_api(lang)
+
+    normalized = dict()
+    result_pages = dict()
+    # content that does not fit in a response is returned in the following
+    # ones
+    for data in wsapi.iter_query(wikisource_api, params, MAX_RETRIES):
+        query = data.get('query', {})
+        for norm in query.get('normalized', []):
+            normalized[norm['to']] = norm['from']
+
+        for pageid, page_data in query.get('pages', {}).items():
+            title = page_data.get('title')
+            if title not in result_pages:
+                result_pages[title] = (pageid, dict(page_data))
+            elif 'revisions' in page_data:
+                result_pages[title][1].setdefault('revisions', []).extend(
+                    page_data['revisions'])
+
+    results = dict()
+    for title, (pageid, page_data) in result_pages.items():
+        page = titles.get(normalized.get(title, title))
+        if page is None:
+            continue
+
+        revisions = page_data.get('revisions', [])
+        if 'missing' in page_data or 'invalid' in page_data or \
+                (len(revisions) == 1 and revisions[0].get('parentid') == 0):
+            results[page] = {'query': {'pages': {pageid: page_data}}}
+
+    for page in pages:
+        if page in results:
+            continue
+
+        if executor is not None:
+            results[page] = executor.submit(fetch_page_revisions,
+                                            book, page, lang, window)
+        else:
+            results[page] = fetch_page_revisions(book, page, lang, window)
+
+    return results
+
+
+class InlineExecutor(object):
+    """Executor that runs the calls in the calling thread, when submitted."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as err:
+            future.set_exception(err)
+        return future
 
-                        user = newUser
-                        other_user = oldUser
+    def __enter__(self):
+        return self
 
-                elif quality_level == SAL[75] and (old is None or old < SAL[75]) \
-                        and timestamp >= contest_start \
-                        and timestamp < contest_end:
+    def __exit__(self, *exc_info):
+        return False
 
 
-                    # User b proofreads the page pag
-                    if old == SAL[50]:
-                        logger.debug("User: {} - Case 1(a)- Proofread the page, SAL 50% -> SAL 75%".format(newUser))
+def prefetch_revisions(pages,
+                       lang,
+                       cache=None,
+                       concurrency=1,
+                       batch=False,
+                       compact=False,
+                       window=None,
+                       contest=None,
+                       touched=None,
+                       edited=None):
+    """Yield (book, page, revisions, state) for every (book, page) in pages.
+
+    Pages are returned in the same order as pages, revisions is the list of
+    Revision of the page, see decode_revisions(). Every page is either:
+      * skipped, without revisions, if touched (a dict book -> set of pages,
+        see get_touched_pages()) does not include it, or if contest is given,
+        the cache has a scoring state of the page and edited (a dict
+        book -> set of pages, see get_edited_since_checked()) includes its
+        book but not the page;
+      * requested from its last revision scored, if contest is given and the
+        cache has a scoring state of the page for contest (see below);
+      * read from the cache, if it is cached and contest is not given;
+      * requested, with fetch_batch_revisions() together with the following
+        pages of the same book if batch, else with fetch_page_revisions()
+        (only the revisions around window, a tuple (start, end) of
+        timestamps, if given). The pages requested are stored in the cache,
+        in the compact format if compact.
+
+    With concurrency > 1 the requests are sent by a pool of threads that runs
+    ahead of the consumer, but the results are still returned in the same
+    order as pages. All the pages are requested to the Wikisource of lang, so
+    concurrency is also the maximum number of concurrent requests to its
+    host. The cache is only accessed from the calling thread.
+
+    With contest, state is the scoring state of the page read from the
+    cache, and only the revisions made since the last one scored are
+    returned (they are not stored in the cache). state is None for the other
+    pages, whose revisions are always requested, since the cached revisions
+    may be older than the last run.
+    """
+    batch_size = BATCH_SIZE if batch else 1
+    if concurrency > 1:
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        # at most this many pages are fetched ahead of the consumer
+        max_pending = concurrency * PREFETCH_FACTOR * batch_size
+    else:
+        # pages are fetched when the consumer asks for them
+        executor = InlineExecutor()
+        max_pending = batch_size
+
+    # entries of pending are (book, page, future, batched, revisions, state,
+    # skipped), the future of a batched page is a list that holds the future
+    # of its batch once the batch is sent
+    pending = deque()
+    # skipped pages are not counted in max_pending, they are never requested
+    num_skipped = 0
+    pages = iter(pages)
+    exhausted = False
+    with executor:
+        to_batch = []
+        batch_future = None
+
+        def submit_batch():
+            batch_future.append(executor.submit(fetch_batch_revisions,
+                                                to_batch[0][0],
+                                                [page for _, page in to_batch],
+                                                lang,
+                                                executor,
+                                                window))
+            del to_batch[:]
+
+        while True:
+            while not exhausted and \
+                    len(pending) - num_skipped < max_pending:
+                try:
+                    book, page = next(pages)
+                except StopIteration:
+                    exhausted = True
+                    break
+
+                page = str(page)
+                skip = touched is not None and \
+                    int(page) not in touched.get(book, ())
+                state = None
+                revisions = None
+                if cache is not None and contest is not None:
+                    state = cache.get_state(lang, book, page, contest)
+                    # not edited since the state was saved
+                    if state is not None and edited is not None and \
+                            book in edited and int(page) not in edited[book]:
+                        skip = True
+                if cache is not None and contest is None and not skip:
+                    revisions = get_cached_revisions(book, page, lang, cache)
+
+                # the pages that are not requested do not interrupt the
+                # batch, they are returned when the batch before them is
+                if skip:
+                    metrics.inc('skipped_pages')
+                    num_skipped += 1
+                    pending.append((book, page, None, False, [], state, True))
+                elif state is not None:
+                    future = executor.submit(fetch_new_revisions,
+                                             book, page, lang, state['revid'])
+                    pending.append((book, page, future, False, None, state,
+                                    False))
+                elif revisions is not None:
+                    logger.info("Request is cached...")
+                    pending.append((book, page, None, False, revisions, None,
+                                    False))
+                elif batch:
+                    if to_batch and to_batch[0][0] != book:
+                        submit_batch()
+                    if not to_batch:
+                        batch_future = []
+                    to_batch.append((book, page))
+                    pending.append((book, page, batch_future, True, None,
+                                    None, False))
+                    if len(to_batch) >= BATCH_SIZE:
+                        submit_batch()
+                else:
+                    future = executor.submit(fetch_page_revisions,
+                                             book, page, lang, window)
+                    pending.append((book, page, future, False, None, None,
+                                    False))
+
+            if not pending:
+                break
+
+            # send an incomplete batch only when there are no more pages to
+            # add to it or when its first page is the next one returned
+            if to_batch and (exhausted or pending[0][2] is batch_future):
+                submit_batch()
+
+            (book, page, future, batched, revisions, state,
+             skipped) = pending.popleft()
+            if skipped:
+                num_skipped -= 1
+            if future is not None:
+                if batched:
+                    data = future[0].result()[page]
+                    if isinstance(data, Future):
+                        data = data.result()
+                else:
+                    data = future.result()
+                if state is not None:
+                    revisions = decode_revisions(data)
+                else:
+                    revisions = store_revisions(book, page, lang, cache, data,
+                                                compact)
+
+            yield book, page, revisions, state
+
+
+class UserLog(object):
+    """Points assigned to the users, written to {directory}/{user}.points.tsv.
+
+    Rows are buffered in memory and appended to the files in bulk, when
+    max_rows rows have been buffered or when the log is flushed. At most
+    max_files files are kept open at the same time. The rows of a user are
+    appended with a single write, so that processes writing to the same files
+    do not mix their lines.
+    """
+
+    fields = ['user', 'punts', 'vali', 'revi',
+              'book', 'page',
+              'quality', 'old_quality',
+              'other_user', 'timestamp' ]
+
+    def __init__(self,
+                 directory,
+                 max_rows=USER_LOG_ROWS,
+                 max_files=USER_LOG_FILES):
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_files = max_files
+        self._rows = dict()
+        self._num_rows = 0
+        # open files, the least recently used first
+        self._files = OrderedDict()
+
+    def write(self, row):
+        self._rows.setdefault(row['user'], []).append(row)
+        self._num_rows += 1
+
+        if self._num_rows >= self.max_rows:
+            self.flush()
+
+    def _open(self, user):
+        fd = self._files.pop(user, None)
+        write_header = False
+
+        if fd is None:
+            if len(self._files) >= self.max_files:
+                _, lru_fd = self._files.popitem(last=False)
+                os.close(lru_fd)
+
+            filename = '{user}.points.tsv'.format(user=user)
+            output = os.path.join(self.directory, filename)
+            try:
+                # only the process that creates the file writes the header
+                fd = os.open(output,
+                             os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL,
+                             0o666)
+                write_header = True
+            except FileExistsError:
+                fd = os.open(output, os.O_WRONLY | os.O_APPEND)
 
-                        punts[newUser] += 3
-                        revi[newUser] += 1
-                        revi3[newUser] += 1
+        self._files[user] = fd
 
-                        assigned_punts = 3
-                        assigned_revi = 1
+        return fd, write_header
 
-                    elif (old is None or old <= SAL[25]):
-                        logger.debug("User: {} - Case 1(b)- Proofread the page, SAL 0/25% -> SAL 75%".format(newUser))
-                        punts[newUser] += 5
-                        revi[newUser] += 1
-                        revi5[newUser] += 1
+    def flush(self):
+        for user, rows in self._rows.items():
+            fd, write_header = self._open(user)
 
-                        assigned_punts = 5
-                        assigned_revi = 1
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf,
+                                    fieldnames=self.fields,
+                                    delimiter='\t',
+                                    quoting=csv.QUOTE_MINIMAL)
+            if write_header:
+                writer.writeheader()
+            writer.writerows(rows)
+
+            data = buf.getvalue().encode('utf-8')
+            while data:
+                data = data[os.write(fd, data):]
+
+        self._rows = dict()
+        self._num_rows = 0
 
-                    user = newUser
-                    other_user = oldUser
+    def close(self):
+        self.flush()
 
-                elif quality_level == SAL[100] and old == SAL[75] \
-                        and timestamp >= contest_start \
-                        and timestamp < contest_end:
+        for fd in self._files.values():
+            os.close(fd)
+        self._files = OrderedDict()
 
-                    # we do not need to check if proofreaderUser and Validetor
-                    # are the same (see above)
-                    # assert proofreaderUser is not None
-                    # if proofreaderUser != newUser:
 
-                    # User b validates page pag
-                    logger.debug("User: {} - Case 2 - Validation".format(newUser))
-                    punts[newUser] += 1
-                    vali[newUser] += 1
+_user_log = None
 
-                    assigned_punts = 1
-                    assigned_vali = 1
 
-                    user = newUser
-                    other_user = oldUser
+def write_user_log(**kwargs):
 
-                elif quality_level == SAL[75] and old == SAL[100] \
-                        and timestamp >= contest_start:
-                    # SAL100->SAL75, after the contest started
-                    if oldTimestamp >= contest_start and oldTimestamp <= contest_end:
-                        # the revert happened during the contest
-                        logger.debug("User: {} - Case 3 - Reverted validation".format(newUser))
-                        # we do not need to check if proofreaderUser and Validetor
-                        # are the same (see above)
-                        # proofreaderUser = newUser
-                        punts[oldUser] -= 1
-                        vali[oldUser] -= 1
+    # Revision(page={page},user={user},"
+    #                              "quality={quality},old_user={old_user},"
+    #                              "old_quality={old_quality},"
+    #                              "timestamp={timestamp})"
 
-                        assigned_punts = -1
-                        assigned_vali = -1
+    global _user_log
 
-                        user = oldUser
-                        other_user = newUser
+    if _user_log is None:
+        _user_log = UserLog(os.path.join('debug', 'points'))
 
-                elif (quality_level < SAL[75] or quality_level is None) and old == SAL[75] \
-                        and timestamp >= contest_start:
-                    # SAL75->SAL0/25/50, after the contest started
-                    if oldTimestamp >= contest_start and oldTimestamp <= contest_end:
-                        # the revert happened during the contest
+    _user_log.write(kwargs)
 
-                        # we do not need to check if proofreaderUser and Validetor
-                        # are the same (see above). Unset the proofreader user.
-                        # proofreaderUser = None
 
-                        if quality_level == SAL[50]:
-                            logger.debug("User: {} - Case 4(a) - Reverted proofread, SAL 75% -> SAL 50%".format(newUser))
-                            punts[oldUser] -= 3
-                            revi[oldUser] -= 1
-                            revi3[newUser] -= 1
+def close_user_log():
+    global _user_log
 
-                            assigned_punts = -3
-                            assigned_revi = -1
+    if _user_log is not None:
+        _user_log.close()
+        _user_log = None
 
-                            user = oldUser
-                            other_user = newUser
 
-                        else:
-                            logger.debug("User: {} - Case 4(a) - Reverted proofread, SAL 75% -> SAL 0/25%".format(newUser))
-                            punts[oldUser] -= 5
-                            revi[oldUser] -= 1
-                            revi5[newUser] -= 1
+class Journal(object):
+    """Journal of the books scored, to resume a run that did not complete.
 
-                            assigned_punts = -5
-                            assigned_revi = -1
+    Every book is appended to journal_file as soon as it has been scored, as
+    a line of JSON with its language, its contest windows and its scores in
+    every window, and the file is synced to the disk. With resume the books
+    of a previous run are read back, otherwise the file is emptied. A last
+    line cut short by a crash is ignored.
+    """
 
-                            user = oldUser
-                            other_user = newUser
+    def __init__(self, journal_file, resume=False):
+        self.journal_file = journal_file
+        self._books = dict()
 
-                elif (quality_level < SAL[50] or quality_level is None) and old == SAL[50] \
-                        and timestamp >= contest_start:
-                    if oldTimestamp >= contest_start and oldTimestamp <= contest_end:
+        if resume:
+            try:
+                with codecs.open(journal_file, 'r', 'utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        key = self._key(entry['lang'],
+                                        entry['book'],
+                                        entry['windows'])
+                        self._books[key] = entry['scores']
+            except IOError:
+                pass
+            logger.info("Resuming from {}: {} books already scored"
+                        .format(journal_file, len(self._books)))
+
+        self._file = codecs.open(journal_file, 'a' if resume else 'w',
+                                 'utf-8')
+
+    @staticmethod
+    def _key(lang, book, windows):
+        return (lang, book, tuple(tuple(window) for window in windows))
+
+    def get(self, lang, book, windows):
+        """Return the scores of book in windows, or None if not scored."""
+        windows_scores = self._books.get(self._key(lang, book, windows))
+        if windows_scores is None:
+            return None
+
+        return [tuple(defaultdict(int, values) for values in scores)
+                for scores in windows_scores]
+
+    def add(self, lang, book, windows, windows_scores):
+        entry = {'lang': lang,
+                 'book': book,
+                 'windows': [list(window) for window in windows],
+                 'scores': [[dict(values) for values in scores]
+                            for scores in windows_scores]
+                 }
+        self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self, remove=False):
+        self._file.close()
+        if remove:
+            os.remove(self.journal_file)
+
+
+def empty_scores():
+    return tuple(defaultdict(int) for _ in SCORE_FIELDS)
+
+
+def score_pages(book, pages, contest_start, contest_end, writer=None,
+                by_page=False):
+    """Compute the points assigned for the revisions of pages of book.
+
+    pages is a list of (pag, revs, state), where state is the
+    (quality, user, timestamp) of the revision preceding revs, if it has been
+    scored already. All the revisions are evaluated as a single batch by
+    scoring.score_transitions(). With writer, every revision is written to it
+    and every point assigned is logged with write_user_log().
+
+    Returns (scores, page_scores, states), where scores is a tuple of dicts
+    user -> value for (punts, vali, revi, revi2, revi3, revi5), page_scores
+    maps the index in pages of the pages with points to their own scores
+    (only with by_page) and states is the (quality, user, timestamp) of the
+    last revision of every page.
+    """
+    old_qualities = []
+    qualities = []
+    old_timestamps = []
+    timestamps = []
+    old_users = []
+    users = []
+    offsets = []
+    states = []
+
+    for pag, revs, state in pages:
+        offsets.append(len(qualities))
+
+        if state is None:
+            old, oldUser, oldTimestamp = None, None, None
+        else:
+            old, oldUser, oldTimestamp = state
+
+        if not revs:
+            states.append((old, oldUser, oldTimestamp))
+            continue
+
+        _, page_timestamps, page_users, page_qualities = zip(*revs)
+
+        old_qualities.append(NO_QUALITY if old is None else old)
+        old_qualities.extend(page_qualities[:-1])
+        qualities.extend(page_qualities)
+        old_timestamps.append(0 if oldTimestamp is None else oldTimestamp)
+        old_timestamps.extend(page_timestamps[:-1])
+        timestamps.extend(page_timestamps)
+        old_users.append(oldUser)
+        old_users.extend(page_users[:-1])
+        users.extend(page_users)
+
+        last = revs[-1]
+        states.append((last.quality, last.user, last.timestamp))
+
+    events = score_transitions(old_qualities, qualities,
+                               old_timestamps, timestamps,
+                               contest_start, contest_end)
+
+    scores = empty_scores()
+    page_scores = dict()
+    for i, case in events:
+        user = users[i]
+        old_user = old_users[i]
+        points = POINTS[case]
+        for field, value, to_old_user in points:
+            scores[field][old_user if to_old_user else user] += value
+
+        if by_page:
+            page = bisect_right(offsets, i) - 1
+            if page not in page_scores:
+                page_scores[page] = empty_scores()
+            for field, value, to_old_user in points:
+                page_scores[page][field][old_user if to_old_user else user] \
+                    += value
+
+    # formatting the debug messages is expensive, do it only if they are
+    # going to be logged
+    log_debug = logger.isEnabledFor(logging.DEBUG)
+    if log_debug or writer is not None:
+        log_revisions(book, pages, offsets, dict(events),
+                      contest_start, contest_end, writer, log_debug)
+
+    return scores, page_scores, states
+
+
+def log_revisions(book, pages, offsets, events, contest_start, contest_end,
+                  writer, log_debug):
+    """Log the revisions of pages and the points assigned by events."""
+    for (pag, revs, state), offset in zip(pages, offsets):
+        page_userlist = defaultdict(int)
+        for rev in revs:
+            page_userlist[rev.user] += 1
+
+        if state is None:
+            old, oldUser, oldTimestamp = None, None, None
+        else:
+            old, oldUser, oldTimestamp = state
+
+        for i, rev in enumerate(revs, offset):
+            timestamp = rev.timestamp
+            quality_level = rev.quality
+            newUser = rev.user
+            in_contest = contest_start <= timestamp < contest_end
+
+            if page_userlist[newUser] > 1:
+                existing_user = 'C' if in_contest else 'D'
+            else:
+                existing_user = 'P' if in_contest else 'N'
+
+            if log_debug and in_contest:
+                logger.debug("Revision(page={page},user={user},"
+                             "quality={quality},old_user={old_user},"
+                             "old_quality={old_quality},"
+                             "timestamp={timestamp})"
+                    .format(page=pag,user=newUser, quality=quality_level,
+                            old_user=oldUser, old_quality=old,
+                            timestamp=format_timestamp(timestamp)))
+            if writer is not None:
+                newUser_padded = "{: <25}".format(newUser or '')
+                oldUser_padded = "{: <25}".format(oldUser or '')
+                old_quality = 0 if old is None else old
+
+                writer.writerow({'user': newUser_padded,
+                                 'existing_user': existing_user,
+                                 'quality': quality_level,
+                                 'old_user': oldUser_padded,
+                                 'old_quality': old_quality,
+                                 'timestamp': format_timestamp(timestamp),
+                                 'page': pag,
+                                 })
+
+            if i in events:
+                case = CASES[events[i]]
+                if log_debug and case.message is not None:
+                    logger.debug("User: {} - {}".format(newUser, case.message))
+
+                if case.kind == GAIN:
+                    user, other_user = newUser, oldUser
+                else:
+                    user, other_user = oldUser, newUser
 
-                        # we do not need to check if proofreaderUser and Validetor
-                        # are the same (see above)
-                        # assert proofreaderUser is None
-
-                        logger.debug("User: {} - Case 5 - Reverted SAL 50% -> SAL 0/25%".format(newUser))
-                        punts[oldUser] -= 2
-                        revi[oldUser] -= 1
-                        revi2[newUser] -= 1
-
-                        assigned_punts = -2
-                        assigned_revi = -2
-
-                        user = oldUser
-                        other_user = newUser
-
-                if debug and assigned_punts:
+                if writer is not None:
+                    assigned_punts, assigned_vali, assigned_revi = case.logged
                     write_user_log(user=user,
                                    punts=assigned_punts,
                                    vali=assigned_vali,
@@ -563,46 +1451,531 @@ def get_score(books_file,
                                    quality=quality_level,
                                    old_quality=old,
                                    other_user=other_user,
-                                   timestamp=timestamp
+                                   timestamp=format_timestamp(timestamp)
                                    )
 
-                old = quality_level
-                oldUser = newUser
-                oldTimestamp = timestamp
+            old = quality_level
+            oldUser = newUser
+            oldTimestamp = timestamp
+
+
+def score_page(book, pag, revs, contest_start, contest_end, state=None,
+               writer=None):
+    """Compute the points assigned for the revisions revs of page pag.
+
+    Returns (scores, state), where scores is a tuple of dicts user -> value
+    for (punts, vali, revi, revi2, revi3, revi5) and state is the
+    (quality, user, timestamp) of the last revision. See score_pages().
+    """
+    scores, _, states = score_pages(book, [(pag, revs, state)],
+                                    contest_start, contest_end, writer)
+
+    return scores, states[0]
+
+
+def score_units(units,
+                lang,
+                cache=None,
+                debug=False,
+                concurrency=CONCURRENCY,
+                batch=False,
+                compact=False,
+                window=None,
+                contest=None,
+                touched=None,
+                edited=None):
+    """Compute the points for units, a list of
+    (book, first page, last page, contest windows).
+
+    The revisions of the pages of a unit are requested once and scored for
+    every one of its contest windows, a list of (start, end) timestamps in
+    seconds since the epoch. Yields, for every unit in order, the list of its
+    scores in every window, as a tuple of dicts user -> value for
+    (punts, vali, revi, revi2, revi3, revi5).
+
+    With debug or contest (see prefetch_revisions()) units must have a single
+    window. With touched only the pages edited during the contests are
+    requested, with edited only the pages with a scoring state that have been
+    edited since the last run, see prefetch_revisions().
+    """
+    revisions = prefetch_revisions(((book, pag)
+                                    for book, first, last, _ in units
+                                    for pag in range(first, last + 1)),
+                                   lang,
+                                   cache,
+                                   concurrency,
+                                   batch,
+                                   compact,
+                                   window,
+                                   contest,
+                                   touched,
+                                   edited)
+
+    for book, first, last, windows in units:
+        logger.info("Processing book... \"{}\"".format(book))
 
-            logger.debug(punts)
-            logger.debug(vali)
-            logger.debug(revi)
+        writer = None
+        if debug:
+            make_debug_dir()
+
+            csv_fields = ['user', 'existing_user', 'quality', 'old_user',
+                          'old_quality', 'timestamp', 'page']
+            revisions_csvfilename = '{book}.revisions.csv'.format(book=book)
+            revisions_csv = os.path.join('debug', 'revisions',
+                                          revisions_csvfilename)
+            revisions_csvfile = open(revisions_csv, 'w')
+            writer = csv.DictWriter(revisions_csvfile,
+                                    fieldnames=csv_fields,
+                                    delimiter='\t',
+                                    quoting=csv.QUOTE_MINIMAL)
+            writer.writeheader()
+
+        logger.info("Querying the API...")
+        pages = []
+        saved_states = []
+        for pag in range(first, last + 1):
+            _, _, revs, state = next(revisions)
+
+            start_state = None
+            if state is not None:
+                revs = [rev for rev in revs if rev.revid > state['revid']]
+                start_state = (state['quality'],
+                               state['user'],
+                               state['timestamp'])
+
+            pages.append((pag, revs, start_state))
+            saved_states.append(state)
+
+        windows_scores = []
+        for contest_start, contest_end in windows:
+            with metrics.timer('score'):
+                book_scores, pages_scores, end_states = \
+                    score_pages(book, pages, contest_start, contest_end,
+                                writer, contest is not None)
+            windows_scores.append(book_scores)
+
+        if contest is not None:
+            for i, (pag, revs, _) in enumerate(pages):
+                state = saved_states[i]
+                page_scores = pages_scores.get(i) or empty_scores()
+
+                if state is not None:
+                    for scores, page_values, saved_values in \
+                            zip(book_scores, page_scores, state['scores']):
+                        for user, value in saved_values.items():
+                            page_values[user] += value
+                            scores[user] += value
+
+                # the state can be saved only if we know the last revision
+                if revs and revs[-1].revid is not None:
+                    quality, user, timestamp = end_states[i]
+                    cache.put_state(lang, book, pag, contest,
+                                    {'revid': revs[-1].revid,
+                                     'quality': quality,
+                                     'user': user,
+                                     'timestamp': timestamp,
+                                     'scores': page_scores
+                                     })
 
         if debug:
             revisions_csvfile.close()
 
-        tot_punts = reduce(add, (Counter(punts), Counter(tot_punts)))
-        tot_vali = reduce(add, (Counter(vali), Counter(tot_vali)))
-        tot_revi = reduce(add, (Counter(revi), Counter(tot_revi)))
-        tot_revi2 = reduce(add, (Counter(revi2), Counter(tot_revi2)))
-        tot_revi3 = reduce(add, (Counter(revi3), Counter(tot_revi3)))
-        tot_revi5 = reduce(add, (Counter(revi5), Counter(tot_revi5)))
+        yield windows_scores
+
+    if debug:
+        close_user_log()
+
 
-        logger.debug(tot_punts)
-        logger.debug(tot_vali)
-        logger.debug(tot_revi)
+def make_units(books, unit_pages=None):
+    """Split books in units of work (index of the book, book, first, last).
 
-    return tot_punts, tot_vali, tot_revi, tot_revi2, tot_revi3, tot_revi5
+    Books with more than unit_pages pages are split in ranges of at most
+    unit_pages pages. Units are returned largest first.
+    """
+    units = []
+    for i, (book, end) in enumerate(books):
+        step = unit_pages or end
+        for first in range(1, end + 1, step):
+            units.append((i, book, first, min(first + step - 1, end)))
+
+    units.sort(key=lambda unit: unit[3] - unit[2], reverse=True)
+
+    return units
+
+
+_worker_cache = None
+
+
+def _init_worker(lang, cache_file, concurrency, log_level):
+    global _worker_cache
+
+    rootlogger.setLevel(log_level)
+    logger.setLevel(log_level)
+
+    if cache_file is not None:
+        _worker_cache = open_cache(cache_file)
+    wsapi.set_host_limit(get_wikisource_api(lang), concurrency)
+
+
+def _score_unit(unit, windows, lang, *args):
+    _, book, first, last = unit
+    windows_scores, = score_units([(book, first, last, windows)], lang,
+                                  _worker_cache, *args)
+
+    # the metrics of the unit are added to the ones of the main process
+    unit_metrics = metrics.snapshot()
+    metrics.reset()
+
+    # the names of the users are sent once for all the fields
+    tables = []
+    for scores in windows_scores:
+        table = ScoreTable()
+        table.add(scores)
+        tables.append(table)
+
+    return tables, unit_metrics
+
+
+def score_books_parallel(books,
+                         books_windows,
+                         lang,
+                         cache_file=None,
+                         debug=False,
+                         concurrency=CONCURRENCY,
+                         batch=False,
+                         compact=False,
+                         window=None,
+                         contest=None,
+                         touched=None,
+                         edited=None,
+                         workers=WORKERS,
+                         done=None):
+    """Compute the points of books with a pool of workers processes.
+
+    books_windows are the contest windows of every book, see score_units().
+    Books, or page ranges of large books, are scheduled largest first. With
+    debug, books are not split, since each book has its own revisions file.
+    Returns the scores of every book in every one of its windows, in order.
+
+    With done, done(i, scores) is called for every book as soon as all its
+    units have been scored, with the index of the book in books.
+    """
+    units = make_units(books, None if debug else UNIT_PAGES)
+    logger.info("Scoring {} books ({} units) with {} workers"
+                .format(len(books), len(units), workers))
+
+    books_scores = [[empty_scores() for _ in windows]
+                    for windows in books_windows]
+    books_tables = [[ScoreTable() for _ in windows]
+                    for windows in books_windows]
+    books_units = Counter(unit[0] for unit in units)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(lang,
+                                       cache_file,
+                                       concurrency,
+                                       logger.getEffectiveLevel())
+                             ) as executor:
+        futures = {executor.submit(_score_unit,
+                                   unit,
+                                   books_windows[unit[0]],
+                                   lang,
+                                   debug,
+                                   concurrency,
+                                   batch,
+                                   compact,
+                                   window,
+                                   contest,
+                                   # only the pages of the book of the unit
+                                   None if touched is None else
+                                   {unit[1]: touched.get(unit[1], set())},
+                                   None if edited is None or
+                                   unit[1] not in edited else
+                                   {unit[1]: edited[unit[1]]}
+                                   ): unit[0]
+                   for unit in units}
+
+        # ranges of the same book are added up, the order does not matter
+        for future in as_completed(futures):
+            unit_tables, unit_metrics = future.result()
+            metrics.merge(unit_metrics)
+
+            i = futures[future]
+            for table, unit_table in zip(books_tables[i], unit_tables):
+                table.merge(unit_table)
+
+            books_units[i] -= 1
+            if not books_units[i]:
+                books_scores[i] = [table.get_scores()
+                                   for table in books_tables[i]]
+                books_tables[i] = None
+                if done is not None:
+                    done(i, books_scores[i])
+
+    return books_scores
 
 
-def get_rows(punts, vali, revi, revi2, revi3, revi5):
+def get_score(books_file,
+              contest_start,
+              contest_end,
+              lang,
+              booklist_cache,
+              enable_cache,
+              cache_file,
+              debug=False,
+              concurrency=CONCURRENCY,
+              batch=False,
+              compact=False,
+              window=False,
+              incremental=False,
+              workers=WORKERS,
+              touched=False,
+              existing=False,
+              journal=None):
+    return get_contests_scores([(books_file, contest_start, contest_end)],
+                               lang,
+                               booklist_cache,
+                               enable_cache,
+                               cache_file,
+                               debug,
+                               concurrency,
+                               batch,
+                               compact,
+                               window,
+                               incremental,
+                               workers,
+                               touched,
+                               existing,
+                               journal)[0]
+
+
+def get_contests_scores(contests,
+                        lang,
+                        booklist_cache,
+                        enable_cache,
+                        cache_file,
+                        debug=False,
+                        concurrency=CONCURRENCY,
+                        batch=False,
+                        compact=False,
+                        window=False,
+                        incremental=False,
+                        workers=WORKERS,
+                        touched=False,
+                        existing=False,
+                        journal=None):
+    """Compute the scores of contests on the Wikisource of lang.
+
+    contests is a list of (books file, start date, end date). The pages of
+    the books of more contests are requested once and scored in the window
+    of every contest that includes the book. Returns the totals of every
+    contest, see get_score().
+
+    With touched, only the pages edited during the contests are requested,
+    see get_touched_pages(). With existing, only the pages that exist and
+    were edited since the start of the contests are requested, see
+    get_existing_pages().
+
+    With journal, a Journal, the books already in the journal are not scored
+    again and every book scored is added to it.
+
+    debug and incremental can be used with a single contest.
+    """
+    # defaults are 0
+    with metrics.timer('booklist'):
+        contests_books = [get_books(books_file, booklist_cache, concurrency)
+                          for books_file, _, _ in contests]
+
+    # revision timestamps are in seconds since the epoch
+    windows = [(calendar.timegm(contest_start.timetuple()),
+                calendar.timegm(contest_end.timetuple()))
+               for _, contest_start, contest_end in contests]
+
+    # the books of all the contests, with the contests that include them
+    books = []
+    books_contests = []
+    index = dict()
+    for i, contest_books in enumerate(contests_books):
+        for book, end in contest_books:
+            if book not in index:
+                index[book] = len(books)
+                books.append((book, end))
+                books_contests.append([])
+            books_contests[index[book]].append(i)
+    books_windows = [[windows[i] for i in book_contests]
+                     for book_contests in books_contests]
+
+    # the books scored by a previous run are restored from the journal
+    books_scores = [None] * len(books)
+    if journal is not None:
+        for i, ((book, _), book_windows) in \
+                enumerate(zip(books, books_windows)):
+            books_scores[i] = journal.get(lang, book, book_windows)
+    todo = [i for i, book_scores in enumerate(books_scores)
+            if book_scores is None]
+    if len(todo) < len(books):
+        logger.info("{} books restored from the journal, {} to score"
+                    .format(len(books) - len(todo), len(todo)))
+    todo_books = [books[i] for i in todo]
+    todo_windows = [books_windows[i] for i in todo]
+
+    def book_done(j, windows_scores):
+        if journal is not None:
+            journal.add(lang, todo_books[j][0], todo_windows[j],
+                        windows_scores)
+
+    # the revisions are requested around all the windows
+    if window:
+        window = (min(start for start, _ in windows),
+                  max(end for _, end in windows))
+    else:
+        window = None
+
+    if touched:
+        with metrics.timer('touched'):
+            touched = get_touched_pages(todo_books,
+                                        lang,
+                                        min(start for start, _ in windows),
+                                        max(end for _, end in windows))
+    else:
+        touched = None
+
+    if existing:
+        with metrics.timer('existing'):
+            existing = get_existing_pages(todo_books,
+                                          lang,
+                                          min(start for start, _ in windows),
+                                          concurrency)
+        if touched is None:
+            touched = existing
+        elif existing is not None:
+            touched = dict((book, pages & existing.get(book, set()))
+                           for book, pages in touched.items())
+
+    # scoring states are saved separately for every contest window
+    contest = None
+    edited = None
+    if incremental:
+        contest = '{}-{}'.format(*windows[0])
+        # the edits made after this are listed by the next run
+        checked = int(time.time())
+        with metrics.timer('edited'):
+            edited = get_edited_since_checked(todo_books,
+                                              lang,
+                                              cache_file,
+                                              contest,
+                                              checked)
+
+    cache = None
+    if workers > 1:
+        todo_scores = score_books_parallel(todo_books,
+                                           todo_windows,
+                                           lang,
+                                           cache_file if enable_cache else None,
+                                           debug,
+                                           concurrency,
+                                           batch,
+                                           compact,
+                                           window,
+                                           contest,
+                                           touched,
+                                           edited,
+                                           workers,
+                                           book_done)
+    else:
+        if enable_cache:
+            cache = open_cache(cache_file)
+
+        wsapi.set_host_limit(get_wikisource_api(lang), concurrency)
+        todo_scores = []
+        for j, windows_scores in enumerate(
+                score_units([(book, 1, end, book_windows)
+                             for (book, end), book_windows
+                             in zip(todo_books, todo_windows)],
+                            lang,
+                            cache,
+                            debug,
+                            concurrency,
+                            batch,
+                            compact,
+                            window,
+                            contest,
+                            touched,
+                            edited)):
+            book_done(j, windows_scores)
+            todo_scores.append(windows_scores)
+
+    for i, windows_scores in zip(todo, todo_scores):
+        books_scores[i] = windows_scores
+
+    # the scores of every contest, book by book in the order of the books
+    # of the contest
+    contests_scores = [[None] * len(contest_books)
+                       for contest_books in contests_books]
+    positions = [dict((book, j) for j, (book, _) in enumerate(contest_books))
+                 for contest_books in contests_books]
+    for (book, _), book_contests, windows_scores in \
+            zip(books, books_contests, books_scores):
+        for i, book_scores in zip(book_contests, windows_scores):
+            contests_scores[i][positions[i][book]] = book_scores
+
+    totals = [sum_scores(contest_scores) for contest_scores in contests_scores]
+
+    # all the pages of the books scored are up to date as of checked
+    if contest is not None:
+        if cache is None:
+            cache = open_cache(cache_file)
+        for book, _ in todo_books:
+            cache.put_checked(lang, book, contest, checked, commit=False)
+        cache.commit()
+
+    if cache is not None:
+        cache.close()
+
+    return totals
+
+
+def sum_scores(books_scores):
+    """Return the totals of books_scores, as a ScoreTable.
+
+    The totals are clamped at 0 after every book, see ScoreTable.add(), so
+    the books are added up in the order of books_scores.
+    """
+    totals = ScoreTable()
+
+    # the totals are merged book by book, in the order of the books file
+    for book_scores in books_scores:
+        logger.debug(book_scores[0])
+        logger.debug(book_scores[1])
+        logger.debug(book_scores[2])
+
+        totals.add(book_scores, clamp=True)
+
+    return totals
+
+
+def get_rows(totals):
+    """Return the rows of the results from totals, a ScoreTable.
+
+    Only the users with points are listed.
+    """
+    punts, vali, revi, revi2, revi3, revi5 = totals.columns
+    users = totals.users
+
     # sorting:
     # results are ordered by:
     # (punts desc, revi desc, vali desc, username asc)
     # to obtain this first first sort by username ascending, then by
     # (punts, revi, vali) descending
-    return [(user, punts[user], vali[user], revi[user],
-             revi2[user], revi3[user], revi5[user]
+    uids = sorted(sorted((uid for uid in range(len(users)) if punts[uid] > 0),
+                         key=users.__getitem__),
+                  key=lambda uid: (punts[uid], revi[uid], vali[uid]),
+                  reverse=True)
+
+    return [(users[uid], punts[uid], vali[uid], revi[uid],
+             revi2[uid], revi3[uid], revi5[uid]
             )
-            for user in sorted(sorted(punts.keys()),
-                               key=lambda u: (punts[u], revi[u], vali[u]),
-                               reverse=True)]
+            for uid in uids]
 
 
 def write_csv(rows, output):
@@ -623,58 +1996,183 @@ def read_config(config_file):
     parser = configparser.ConfigParser()
     parser.read(config_file)
 
-    config['contest'] = dict([(k ,v) for k, v in parser['contest'].items()])
+    # a single [contest] section or more [contest NAME] sections
+    config['contests'] = [(section.partition(' ')[2].strip() or section,
+                           dict([(k ,v) for k, v in parser[section].items()]))
+                          for section in parser.sections()
+                          if section.split(' ', 1)[0] == 'contest']
+    config['contest'] = config['contests'][0][1]
     return config
 
 
+def get_contest_output(output, books_file, name, several):
+    """Return the output file of the contest name.
+
+    {BOOKS_FILE} and {CONTEST} in output are replaced with books_file and
+    name, with several contests and without {CONTEST} the name is added
+    before the extension of output.
+    """
+    if "BOOKS_FILE" in output:
+        output = output.replace('{BOOKS_FILE}', books_file)
+
+    if "CONTEST" in output:
+        output = output.replace('{CONTEST}', name)
+    elif several:
+        root, ext = os.path.splitext(output)
+        output = '{}.{}{}'.format(root, name, ext)
+
+    return output
+
+
 def main(config):
-    books_file = config['books_file']
-    contest_start = datetime.strptime(config['contest']['start_date'], "%Y-%m-%d %H:%M:%S")
-    contest_end = datetime.strptime(config['contest']['end_date'], "%Y-%m-%d %H:%M:%S")
-    lang = config['contest']['language']
     booklist_cache = config['booklist_cache']
     cache_file = config['cache_file']
     enable_cache = config['enable_cache']
-    output = config['output']
     debug = config['debug']
-
-    scores = get_score(books_file,
-                       contest_start,
-                       contest_end,
-                       lang,
-                       booklist_cache,
-                       enable_cache,
-                       cache_file,
-                       debug)
-
-    rows = get_rows(*scores)
-
-    write_csv(rows, output)
+    concurrency = config['concurrency']
+    batch = config['batch']
+    compact = config['compact_cache']
+    window = config['window']
+    incremental = config['incremental']
+    workers = config['workers']
+
+    contests = config['contests']
+    for contest in contests:
+        contest['start'] = datetime.strptime(contest['start_date'], "%Y-%m-%d %H:%M:%S")
+        contest['end'] = datetime.strptime(contest['end_date'], "%Y-%m-%d %H:%M:%S")
+
+    # legacy caches and dumps are of a single Wikisource
+    lang = contests[0]['language']
+
+    # the directory of a sharded cache is created with its manifest
+    if config['cache_dir']:
+        ShardedCache(cache_file).close()
+
+    if config['import_cache']:
+        cache = open_cache(cache_file)
+        import_json_cache(config['import_cache'], cache, lang)
+        cache.close()
+
+    if config['dump']:
+        books = OrderedDict()
+        for books_file in set(contest['books_file'] for contest in contests):
+            books.update(get_books(books_file, booklist_cache, concurrency))
+        cache = open_cache(cache_file)
+        with metrics.timer('dump'):
+            import_dump(config['dump'], list(books.items()), lang, cache,
+                        config['dump_namespace'])
+        cache.close()
+
+    journal = Journal(config['journal'], config['resume'])
+
+    # the contests on the same Wikisource are scored together
+    languages = OrderedDict()
+    for contest in contests:
+        languages.setdefault(contest['language'], []).append(contest)
+
+    for lang, lang_contests in languages.items():
+        contests_scores = get_contests_scores(
+            [(contest['books_file'], contest['start'], contest['end'])
+             for contest in lang_contests],
+            lang,
+            booklist_cache,
+            enable_cache,
+            cache_file,
+            debug,
+            concurrency,
+            batch,
+            compact,
+            window,
+            incremental,
+            workers,
+            config['touched'],
+            config['existing'],
+            journal)
+
+        with metrics.timer('write'):
+            for contest, scores in zip(lang_contests, contests_scores):
+                rows = get_rows(scores)
+
+                logger.info("Writing results: {}".format(contest['output']))
+                write_csv(rows, contest['output'])
+
+    # the run is complete, there is nothing left to resume
+    journal.close(remove=True)
+
+    report = metrics.get_report('score.py',
+                                books_file=[contest['books_file']
+                                            for contest in contests],
+                                output=[contest['output']
+                                        for contest in contests],
+                                concurrency=concurrency,
+                                workers=workers)
+    metrics.write_report(report, config['metrics_output'])
+    if config['prometheus']:
+        metrics.write_prometheus(report, config['prometheus'])
 
 
 if __name__ == '__main__':
 
     DESCRIPTION = 'Count proofread and validated pages for the Wikisource contest.'
     parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--batch', action='store_true',
+                        help='Request the pages in batches of {} titles'.format(BATCH_SIZE))
     parser.add_argument('--booklist-cache', default=BOOKLIST_CACHE_FILE, metavar='BOOKLIST_CACHE',
                         help='JSON file to read and store the booklist cache (default: {})'.format(BOOKLIST_CACHE_FILE))
     parser.add_argument('--cache', default=CACHE_FILE, metavar='CACHE_FILE',
-                        help='JSON file to read and store the cache (default: {})'.format(CACHE_FILE))
+                        help='SQLite file to read and store the cache (default: {})'.format(CACHE_FILE))
+    parser.add_argument('--cache-dir', metavar='CACHE_DIR',
+                        help='Directory of a cache with a file for every book, instead of --cache '
+                             '(implies --enable-cache)')
+    parser.add_argument('--compact-cache', action='store_true',
+                        help='Store in the cache only the data needed to compute the scores')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, metavar='N',
+                        help='Number of concurrent requests to the Wikisource API (default: {})'.format(CONCURRENCY))
     parser.add_argument('--config', default=CONFIG_FILE, metavar='CONFIG_FILE',
                         help='INI file to read configs (default: {})'.format(CONFIG_FILE))
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Enable debug output (implies -v)')
+    parser.add_argument('--dump', action='append', metavar='DUMP_FILE',
+                        help='Read the pages from a XML history dump, compressed or not, '
+                             'can be repeated (implies --enable-cache)')
+    parser.add_argument('--dump-namespace', type=int, metavar='NS',
+                        help='Number of the Page namespace in the dumps (default: any)')
     parser.add_argument('--enable-cache', action='store_true',
                         help='Enable caching')
+    parser.add_argument('--existing', action='store_true',
+                        help='Request only the pages that exist and were edited since the start of the contest')
+    parser.add_argument('--import-cache', metavar='JSON_CACHE',
+                        help='Import a JSON cache written by older versions of this script (implies --enable-cache)')
     parser.add_argument('-f', default=BOOKS_FILE, metavar='BOOKS_FILE',
                         help='TSV file with the books to be processed (default: {})'.format(BOOKS_FILE))
+    parser.add_argument('--journal', default=JOURNAL_FILE, metavar='JOURNAL_FILE',
+                        help='File to record the books scored, to resume the run (default: {})'.format(JOURNAL_FILE))
+    parser.add_argument('--incremental', action='store_true',
+                        help='Score only the revisions made since the last run (implies --enable-cache)')
     parser.add_argument('-o', default=OUTPUT_TSV, metavar='OUTPUT_TSV',
                         help='Output file (default: {})'.format(OUTPUT_TSV))
+    parser.add_argument('--metrics-output', default=METRICS_OUTPUT, metavar='METRICS_FILE',
+                        help='JSON file to write the metrics of the run (default: {})'.format(METRICS_OUTPUT))
+    parser.add_argument('--prometheus', metavar='PROM_FILE',
+                        help='Also write the metrics of the run in the Prometheus text format')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume a run that did not complete, without scoring again the books in the journal')
+    parser.add_argument('--touched', action='store_true',
+                        help='Request only the pages edited during the contest')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Enable verbose output')
+    parser.add_argument('--window', action='store_true',
+                        help='Request only the revisions made around the contest dates')
+    parser.add_argument('--workers', type=int, default=WORKERS, metavar='N',
+                        help='Number of worker processes scoring books at the same time (default: {})'.format(WORKERS))
 
     args = parser.parse_args()
 
+    if args.dump and args.incremental:
+        parser.error('--dump cannot be used with --incremental')
+    if args.cache_dir and args.cache != CACHE_FILE:
+        parser.error('--cache cannot be used with --cache-dir')
+
     config_file = args.config
     config = read_config(config_file)
 
@@ -688,19 +2186,66 @@ if __name__ == '__main__':
         config['booklist_cache'] = args.booklist_cache
 
     # Cache file
-    config['enable_cache'] = args.enable_cache
-    if "BOOKS_FILE" in args.cache:
+    config['enable_cache'] = args.enable_cache or bool(args.import_cache) \
+        or args.incremental or bool(args.dump) or bool(args.cache_dir)
+    config['compact_cache'] = args.compact_cache
+    config['import_cache'] = args.import_cache
+    config['dump'] = args.dump
+    config['dump_namespace'] = args.dump_namespace
+    config['cache_dir'] = bool(args.cache_dir)
+    if args.cache_dir:
+        config['cache_file'] = args.cache_dir
+    elif "BOOKS_FILE" in args.cache:
         config['cache_file'] = args.cache.format(
             BOOKS_FILE=config['books_file'])
     else:
         config['cache_file'] = args.cache
 
-    # TSV output
-    if "BOOKS_FILE" in args.o:
-        config['output'] = args.o.format(
-            BOOKS_FILE=config['books_file'])
+    # Contests, every one with its books file and TSV output
+    sections = config['contests']
+    config['contests'] = []
+    for name, section in sections:
+        contest = dict(section)
+        contest['name'] = name
+        contest.setdefault('books_file', config['books_file'])
+        # the output of a section is used as it is
+        contest['output'] = get_contest_output(section.get('output', args.o),
+                                               contest['books_file'],
+                                               name,
+                                               len(sections) > 1 and
+                                               'output' not in section)
+        config['contests'].append(contest)
+    config['output'] = config['contests'][0]['output']
+
+    if len(sections) > 1 and (args.debug or args.incremental):
+        parser.error('-d and --incremental can be used with a single contest')
+    if args.dump and len(set(contest['language']
+                             for contest in config['contests'])) > 1:
+        parser.error('--dump can be used only with contests of a single language')
+
+    # Metrics
+    if "OUTPUT_TSV" in args.metrics_output:
+        config['metrics_output'] = args.metrics_output.format(
+            OUTPUT_TSV=config['output'])
     else:
-        config['output'] = args.o
+        config['metrics_output'] = args.metrics_output
+    config['prometheus'] = args.prometheus
+
+    # Journal
+    if "OUTPUT_TSV" in args.journal:
+        config['journal'] = args.journal.format(OUTPUT_TSV=config['output'])
+    else:
+        config['journal'] = args.journal
+    config['resume'] = args.resume
+
+    # Requests
+    config['concurrency'] = args.concurrency
+    config['batch'] = args.batch
+    config['window'] = args.window
+    config['incremental'] = args.incremental
+    config['workers'] = args.workers
+    config['touched'] = args.touched
+    config['existing'] = args.existing
 
     # Verbosity/Debug
     config['verbose'] = args.verbose or args.debug
@@ -723,7 +2268,11 @@ if __name__ == '__main__':
     logger.debug(args)
     logger.debug(config)
 
-    main(config)
+    try:
+        main(config)
+    except wsapi.RequestFailed as err:
+        logger.error(err)
+        exit(1)
 
     logger.info("All done!")
 
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+scoring.py
+Rules to assign points for the Wikisource anniversary contest.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+Every revision of a page is a transition from the quality level of the
+previous revision (old quality, None if the page did not exist) to a new
+quality level. The transition table TRANSITIONS maps (old quality, new
+quality) to the case of the rules that applies, and CASES gives the points
+assigned in each case. Points are assigned only if the revision, and for
+reverts the reverted revision, has been made during the contest.
+
+score_transitions() evaluates a whole batch of transitions at once, with
+NumPy if it is available.
+
+Points are (punts, vali, revi, revi2, revi3, revi5), see SCORE_FIELDS:
+  * punts: points;
+  * vali: validated pages (SAL 75% -> SAL 100%);
+  * revi: proofread pages;
+  * revi2, revi3, revi5: proofread pages worth 2, 3 and 5 points.
+
+The totals of the users are added up in a ScoreTable, with a column of
+integers for every field and a row for every user.
+
+The points are the ones computed by the original get_score() of score.py,
+quirks included, so that the results do not change: reverts remove revi2,
+revi3 and revi5 from the user of the revert (see CASES), and the totals are
+clamped at 0 after every book (see ScoreTable.add()).
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+from array import array
+from collections import namedtuple
+
+# Try to use NumPy to evaluate batches of transitions
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+### GLOBALS AND DEFAULTS ###
+#SAL:
+SAL = {0: 0, 25: 1, 50: 2, 75: 3, 100: 4}
+
+# quality of the revision preceding the first one of a page
+NO_QUALITY = -1
+# quality levels are a single digit
+MAX_QUALITY = 9
+
+SCORE_FIELDS = ['punts', 'vali', 'revi', 'revi2', 'revi3', 'revi5']
+
+# batches smaller than this are evaluated without NumPy
+NUMPY_MIN_BATCH = 64
+
+# kinds of case
+NO_POINTS = 0
+# points are assigned for a revision made during the contest
+GAIN = 1
+# points are removed for a revision made during the contest, that has been
+# reverted after the start of the contest
+REVERT = 2
+### ###
+
+
+# new_user and old_user are the points assigned to the user of the revision
+# and to the user of the previous revision, in the order of SCORE_FIELDS.
+# logged are the (punts, vali, revi) reported in the debug output.
+Case = namedtuple('Case', ['kind', 'new_user', 'old_user', 'logged',
+                           'message'])
+
+CASES = [
+    # no points
+    Case(NO_POINTS, (0, 0, 0, 0, 0, 0), (0, 0, 0, 0, 0, 0), (0, 0, 0), None),
+    # SAL 0/25% -> SAL 50%
+    Case(GAIN, (2, 0, 1, 1, 0, 0), (0, 0, 0, 0, 0, 0), (2, 0, 1), None),
+    # User b proofreads the page
+    Case(GAIN, (3, 0, 1, 0, 1, 0), (0, 0, 0, 0, 0, 0), (3, 0, 1),
+         "Case 1(a)- Proofread the page, SAL 50% -> SAL 75%"),
+    Case(GAIN, (5, 0, 1, 0, 0, 1), (0, 0, 0, 0, 0, 0), (5, 0, 1),
+         "Case 1(b)- Proofread the page, SAL 0/25% -> SAL 75%"),
+    # User b validates the page
+    Case(GAIN, (1, 1, 0, 0, 0, 0), (0, 0, 0, 0, 0, 0), (1, 1, 0),
+         "Case 2 - Validation"),
+    # Reverts remove the points from the user of the reverted revision, but
+    # revi2, revi3 and revi5 are removed from the user of the revert (and the
+    # debug output of Case 5 reports revi = -2).
+    Case(REVERT, (0, 0, 0, 0, 0, 0), (-1, -1, 0, 0, 0, 0), (-1, -1, 0),
+         "Case 3 - Reverted validation"),
+    Case(REVERT, (0, 0, 0, 0, -1, 0), (-3, 0, -1, 0, 0, 0), (-3, 0, -1),
+         "Case 4(a) - Reverted proofread, SAL 75% -> SAL 50%"),
+    Case(REVERT, (0, 0, 0, 0, 0, -1), (-5, 0, -1, 0, 0, 0), (-5, 0, -1),
+         "Case 4(a) - Reverted proofread, SAL 75% -> SAL 0/25%"),
+    Case(REVERT, (0, 0, 0, -1, 0, 0), (-2, 0, -1, 0, 0, 0), (-2, 0, -2),
+         "Case 5 - Reverted SAL 50% -> SAL 0/25%"),
+    ]
+
+(CASE_NONE, CASE_50, CASE_1A, CASE_1B, CASE_2, CASE_3, CASE_4A_50,
+ CASE_4A_25, CASE_5) = range(len(CASES))
+
+
+def _make_transitions():
+    # TRANSITIONS[old + 1][new], NO_QUALITY is at index 0
+    table = [[CASE_NONE] * (MAX_QUALITY + 1) for _ in range(MAX_QUALITY + 2)]
+
+    def set_case(old, new, case):
+        table[old + 1][new] = case
+
+    for old in (NO_QUALITY, SAL[0], SAL[25]):
+        set_case(old, SAL[50], CASE_50)
+        set_case(old, SAL[75], CASE_1B)
+    set_case(SAL[50], SAL[75], CASE_1A)
+    set_case(SAL[75], SAL[100], CASE_2)
+    set_case(SAL[100], SAL[75], CASE_3)
+    set_case(SAL[75], SAL[50], CASE_4A_50)
+    for new in (SAL[0], SAL[25]):
+        set_case(SAL[75], new, CASE_4A_25)
+        set_case(SAL[50], new, CASE_5)
+
+    return table
+
+
+TRANSITIONS = _make_transitions()
+KINDS = [case.kind for case in CASES]
+# POINTS[case] lists the (field, value, to_old_user) of the non-zero points,
+# field is the index in SCORE_FIELDS.
+POINTS = [[(field, value, False)
+           for field, value in enumerate(case.new_user) if value] +
+          [(field, value, True)
+           for field, value in enumerate(case.old_user) if value]
+          for case in CASES]
+
+if np is not None:
+    TRANSITIONS_ARRAY = np.array(TRANSITIONS, dtype=np.int8)
+    KINDS_ARRAY = np.array(KINDS, dtype=np.int8)
+
+
+def get_case(old_quality, new_quality, timestamp, old_timestamp,
+             contest_start, contest_end):
+    """Return the case of a single transition, CASE_NONE if no points."""
+    case = TRANSITIONS[old_quality + 1][new_quality]
+    kind = KINDS[case]
+
+    if kind == GAIN:
+        if contest_start <= timestamp < contest_end:
+            return case
+    elif kind == REVERT:
+        if timestamp >= contest_start and \
+                contest_start <= old_timestamp <= contest_end:
+            return case
+
+    return CASE_NONE
+
+
+def score_transitions(old_qualities,
+                      qualities,
+                      old_timestamps,
+                      timestamps,
+                      contest_start,
+                      contest_end):
+    """Evaluate a batch of transitions.
+
+    The arguments are sequences with one element per transition: the quality
+    and timestamp of the previous revision (NO_QUALITY and any timestamp if
+    there is no previous revision) and of the revision. Timestamps are in
+    seconds since the epoch.
+
+    Returns the list of (index, case) of the transitions that assign points.
+    """
+    if np is None or len(qualities) < NUMPY_MIN_BATCH:
+        events = []
+        for i, (old, new, old_ts, ts) in enumerate(zip(old_qualities,
+                                                        qualities,
+                                                        old_timestamps,
+                                                        timestamps)):
+            case = get_case(old, new, ts, old_ts, contest_start, contest_end)
+            if case != CASE_NONE:
+                events.append((i, case))
+
+        return events
+
+    old_qualities = np.asarray(old_qualities, dtype=np.int8)
+    qualities = np.asarray(qualities, dtype=np.int8)
+    old_timestamps = np.asarray(old_timestamps, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+
+    cases = TRANSITIONS_ARRAY[old_qualities + 1, qualities]
+    kinds = KINDS_ARRAY[cases]
+
+    after_start = timestamps >= contest_start
+    gain = (kinds == GAIN) & after_start & (timestamps < contest_end)
+    revert = (kinds == REVERT) & after_start & \
+        (old_timestamps >= contest_start) & (old_timestamps <= contest_end)
+
+    indexes = np.flatnonzero(gain | revert)
+
+    return list(zip(indexes.tolist(), cases[indexes].tolist()))
+
+
+class ScoreTable(object):
+    """Points of the users, with a column for every field of SCORE_FIELDS.
+
+    User names are interned: users[uid] is the name of the user whose points
+    are at index uid of every column, ids maps the names back to uid. The
+    columns are arrays of integers updated in place, tables of different
+    processes can be added up with merge().
+    """
+
+    def __init__(self):
+        self.users = []
+        self.ids = dict()
+        self.columns = [array('q') for _ in SCORE_FIELDS]
+
+    def __len__(self):
+        return len(self.users)
+
+    def user_id(self, user):
+        uid = self.ids.get(user)
+        if uid is None:
+            uid = len(self.users)
+            self.ids[user] = uid
+            self.users.append(user)
+            for column in self.columns:
+                column.append(0)
+
+        return uid
+
+    def add(self, scores, clamp=False):
+        """Add scores, a tuple of dicts user -> value (one per field).
+
+        With clamp, the totals of the users in scores that are not positive
+        are set to 0, as adding up Counter objects does.
+        """
+        user_id = self.user_id
+        for column, values in zip(self.columns, scores):
+            for user, value in values.items():
+                uid = user_id(user)
+                total = column[uid] + value
+                if clamp and total < 0:
+                    total = 0
+                column[uid] = total
+
+    def merge(self, other):
+        """Add the columns of other, another ScoreTable."""
+        uids = [self.user_id(user) for user in other.users]
+        for column, other_column in zip(self.columns, other.columns):
+            for uid, value in zip(uids, other_column):
+                column[uid] += value
+
+    def get_scores(self):
+        """Return the points as a tuple of dicts user -> value (one per field).
+
+        Users with no points in a field are left out of its dict.
+        """
+        return tuple(dict((user, value)
+                          for user, value in zip(self.users, column) if value)
+                     for column in self.columns)
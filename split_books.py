@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+split_books.py
+Split the list of books in sub-lists with about the same number of pages.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+usage: split_books.py [-h] [--booklist-cache BOOKLIST_CACHE]
+                      [--concurrency N] [-d] [-f BOOKS_FILE] [-n NUM_CHUNKS]
+                      [--prefix PREFIX] [-v]
+
+Split the list of books in sub-lists with about the same number of pages.
+
+optional arguments:
+  -h, --help            show this help message and exit
+  --booklist-cache BOOKLIST_CACHE
+                        JSON file to read and store the booklist cache
+                        (default: {BOOKS_FILE}.booklist_cache.json)
+  --concurrency N       Number of concurrent requests to the Commons API
+                        (default: 1)
+  -d                    Enable debug output (implies -v)
+  -f BOOKS_FILE         TSV file with the books to be processed (default:
+                        books.tsv)
+  -n NUM_CHUNKS         Number of sub-lists (default: 1)
+  --prefix PREFIX       Prefix of the sub-lists, they are named
+                        {PREFIX}NN_sublist.tsv (default: books)
+  -v                    Enable verbose output
+
+---
+The number of pages of every book is read from the booklist cache, books that
+are not in the cache are requested to Commons (as score.py does) and added to
+the cache, so that the cache can be shared by all the runs of score.py on the
+sub-lists.
+
+Books are assigned, from the largest one, to the sub-list with the fewest pages
+so far. The books of every sub-list are written in the same order as they are
+processed by score.py.
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import heapq
+import codecs
+import logging
+import argparse
+
+import score
+from score import get_books
+
+
+### GLOBALS AND DEFAULTS ###
+# Files
+BOOKS_FILE = 'books.tsv'
+BOOKLIST_CACHE_FILE = '{BOOKS_FILE}.booklist_cache.json'
+SUBLIST_FILE = '{prefix}{num}_sublist.tsv'
+
+# params
+PREFIX = 'books'
+NUM_CHUNKS = 1
+CONCURRENCY = 1
+### ###
+
+# logging is configured by score.py
+logger = logging.getLogger('score')
+
+
+def split_books(books, num_chunks):
+    """Split books, a list of (book, number of pages), in num_chunks lists.
+
+    Returns the lists of books, with the total number of pages of each list.
+    """
+    order = dict((book, i) for i, (book, _) in enumerate(books))
+
+    # (pages, index of the chunk), the chunk with the fewest pages comes first
+    totals = [(0, i) for i in range(num_chunks)]
+    chunks = [[] for _ in range(num_chunks)]
+    for book, pages in sorted(books, key=lambda b: b[1], reverse=True):
+        total, i = heapq.heappop(totals)
+        chunks[i].append(book)
+        heapq.heappush(totals, (total + pages, i))
+
+    pages = dict((i, total) for total, i in totals)
+
+    return [(sorted(chunk, key=order.get), pages[i])
+            for i, chunk in enumerate(chunks)]
+
+
+def write_sublists(chunks, prefix):
+    chunks = [(chunk, pages) for chunk, pages in chunks if chunk]
+
+    # the same numbering of `seq -w 01 N`, with at least two digits
+    width = max(2, len(str(len(chunks))))
+
+    for num, (chunk, pages) in enumerate(chunks, 1):
+        sublist_file = SUBLIST_FILE.format(prefix=prefix,
+                                           num=str(num).zfill(width))
+        logger.info("{}: {} books, {} pages".format(sublist_file,
+                                                     len(chunk),
+                                                     pages))
+        with codecs.open(sublist_file, 'w', 'utf-8') as f:
+            for book in chunk:
+                f.write('{}\n'.format(book))
+
+    return len(chunks)
+
+
+def main(config):
+    books = get_books(config['books_file'],
+                      config['booklist_cache'],
+                      config['concurrency'])
+
+    chunks = split_books(books, config['num_chunks'])
+    num_sublists = write_sublists(chunks, config['prefix'])
+
+    logger.info("Written {} sub-lists".format(num_sublists))
+
+
+if __name__ == '__main__':
+
+    DESCRIPTION = 'Split the list of books in sub-lists with about the same number of pages.'
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument('--booklist-cache', default=BOOKLIST_CACHE_FILE, metavar='BOOKLIST_CACHE',
+                        help='JSON file to read and store the booklist cache (default: {})'.format(BOOKLIST_CACHE_FILE))
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, metavar='N',
+                        help='Number of concurrent requests to the Commons API (default: {})'.format(CONCURRENCY))
+    parser.add_argument('-d', '--debug', action='store_true',
+                        help='Enable debug output (implies -v)')
+    parser.add_argument('-f', default=BOOKS_FILE, metavar='BOOKS_FILE',
+                        help='TSV file with the books to be processed (default: {})'.format(BOOKS_FILE))
+    parser.add_argument('-n', type=int, default=NUM_CHUNKS, metavar='NUM_CHUNKS',
+                        help='Number of sub-lists (default: {})'.format(NUM_CHUNKS))
+    parser.add_argument('--prefix', default=PREFIX,
+                        help='Prefix of the sub-lists, they are named {{PREFIX}}NN_sublist.tsv (default: {})'.format(PREFIX))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='Enable verbose output')
+
+    args = parser.parse_args()
+
+    config = dict()
+    config['books_file'] = args.f
+    if "BOOKS_FILE" in args.booklist_cache:
+        config['booklist_cache'] = args.booklist_cache.format(
+            BOOKS_FILE=config['books_file'])
+    else:
+        config['booklist_cache'] = args.booklist_cache
+    config['concurrency'] = args.concurrency
+    config['num_chunks'] = max(args.n, 1)
+    config['prefix'] = args.prefix
+
+    # Verbosity/Debug
+    config['verbose'] = args.verbose or args.debug
+    config['debug'] = args.debug
+
+    lvl_config_logger = logging.WARNING
+    if config['verbose']:
+        lvl_config_logger = logging.INFO
+
+    if config['debug']:
+        lvl_config_logger = logging.DEBUG
+
+    formatter = logging.Formatter(score.LOGFORMAT_STDOUT[lvl_config_logger])
+    score.console.setFormatter(formatter)
+    score.rootlogger.setLevel(lvl_config_logger)
+    logger.setLevel(lvl_config_logger)
+
+    logger.debug(args)
+    logger.debug(config)
+
+    main(config)
+
+    exit(0)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+wsapi.py
+HTTP client for the MediaWiki APIs used by the wscontest-votecounter scripts.
+
+This script is part of wscontest-votecounter.
+(<https://github.com/CristianCantoro/wscontest-votecounter>)
+
+---
+Requests to the same host reuse a pool of keep-alive connections and ask for
+gzip-compressed responses. The number of connections open at the same time
+towards each host is limited, see set_host_limit().
+
+API requests are sent with the maxlag parameter, failed requests are retried
+with exponential backoff and jitter, honouring the Retry-After header of the
+responses. Errors of the API are raised: the transient ones are retried, the
+others fail the request at once. The concurrency towards a host adapts to its
+errors: it is halved when the host throttles the requests or fails, and grows
+back by about one request for every round of successful requests, up to the
+limit of the host (additive increase, multiplicative decrease).
+
+---
+The MIT License (MIT)
+
+wscontest-votecounter:
+Copyright (c) 2015 CristianCantoro <kikkocristian@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import gzip
+import time
+import random
+import logging
+import threading
+import http.client
+import urllib.parse
+import email.utils
+
+# Try to use yajl, a faster module for JSON
+# import json
+try:
+    import yajl as json
+except ImportError:
+    import json
+
+import metrics
+
+
+### GLOBALS AND DEFAULTS ###
+USER_AGENT = ('wscontest-votecounter '
+              '(https://github.com/CristianCantoro/wscontest-votecounter)')
+
+# params
+# number of times to retry failing requests
+MAX_RETRIES = 10
+# time (in seconds) to wait before the first retry, it doubles at every retry
+WAIT_TIME = 0.5
+# maximum time (in seconds) to wait between retries
+MAX_WAIT_TIME = 60
+# maximum replication lag (in seconds) of the database servers, see
+# https://www.mediawiki.org/wiki/Manual:Maxlag_parameter
+MAXLAG = 5
+# errors of the API that throttle the requests, they are retried after
+# waiting Retry-After (or MAXLAG)
+RETRY_API_ERRORS = set(['maxlag', 'ratelimited'])
+# other errors of the API that are retried, with backoff()
+TRANSIENT_API_ERRORS = set(['readonly'])
+TRANSIENT_API_ERROR_PREFIXES = ('internal_api_error_', )
+# HTTP statuses of throttled requests
+THROTTLE_STATUSES = set([429, 503])
+# the concurrency towards a host is halved at most once in this time (in
+# seconds), so that the failures of the requests already sent count once
+DECREASE_INTERVAL = 1
+# timeout (in seconds) for connecting and reading a response
+TIMEOUT = 60
+# default number of connections open at the same time towards a host
+HOST_LIMIT = 1
+
+_host_limits = dict()
+_pools = dict()
+_pools_lock = threading.Lock()
+### ###
+
+logger = logging.getLogger('score')
+
+
+class HTTPError(IOError):
+    def __init__(self, status, reason, headers):
+        super(HTTPError, self).__init__(
+            'HTTP Error {}: {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+
+class APIError(IOError):
+    def __init__(self, code, info, retry_after=None):
+        super(APIError, self).__init__(
+            'API Error {}: {}'.format(code, info))
+        self.code = code
+        self.info = info
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self):
+        return self.code in RETRY_API_ERRORS
+
+    @property
+    def transient(self):
+        return self.throttled or self.code in TRANSIENT_API_ERRORS or \
+            (self.code or '').startswith(TRANSIENT_API_ERROR_PREFIXES)
+
+
+class RequestFailed(IOError):
+    def __init__(self, url, params, attempts, error):
+        super(RequestFailed, self).__init__(
+            'Request to {} ({}) failed after {} attempts: {}'.format(
+                url, params.get('titles', params.get('action')), attempts,
+                error))
+        self.url = url
+        self.params = params
+        self.attempts = attempts
+        self.error = error
+
+    def __reduce__(self):
+        # to be raised again by the workers of score.py
+        return (RequestFailed,
+                (self.url, self.params, self.attempts, str(self.error)))
+
+
+class ConnectionPool(object):
+    """Keep-alive connections towards a single host.
+
+    At most limit requests are sent to the host at the same time, idle
+    connections are kept open and reused by the following requests. limit
+    starts at maxsize and is adjusted with throttle() and success().
+    """
+
+    def __init__(self, scheme, host, maxsize):
+        self.scheme = scheme
+        self.host = host
+        self.maxsize = maxsize
+        self.limit = float(maxsize)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.Condition()
+        self._active = 0
+        # no requests are sent before this time (of time.monotonic())
+        self._resume = 0.0
+        self._last_decrease = 0.0
+
+    def _acquire(self):
+        with self._slots:
+            while True:
+                wait = self._resume - time.monotonic()
+                if wait <= 0 and self._active < int(self.limit):
+                    break
+                self._slots.wait(wait if wait > 0 else None)
+            self._active += 1
+
+    def _release(self):
+        with self._slots:
+            self._active -= 1
+            self._slots.notify_all()
+
+    def success(self):
+        with self._slots:
+            if self.limit < self.maxsize:
+                self.limit = min(self.maxsize, self.limit + 1 / self.limit)
+                self._slots.notify_all()
+
+    def throttle(self, pause=0):
+        """Halve the concurrency, send no requests for pause seconds."""
+        with self._slots:
+            now = time.monotonic()
+            if now - self._last_decrease >= DECREASE_INTERVAL:
+                self._last_decrease = now
+                self.limit = max(1.0, self.limit / 2)
+                logger.debug("Concurrency towards {} reduced to {}"
+                             .format(self.host, int(self.limit)))
+            self._resume = max(self._resume, now + pause)
+
+    def _new_connection(self):
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, timeout=TIMEOUT)
+        else:
+            return http.client.HTTPConnection(self.host, timeout=TIMEOUT)
+
+    def _get_connection(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+
+        return self._new_connection(), False
+
+    def _put_connection(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def request(self, method, path, body=None, headers=None):
+        self._acquire()
+        try:
+            conn, reused = self._get_connection()
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                content = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the server may have closed an idle connection, retry once
+                # with a new one.
+                if not reused:
+                    raise
+                conn = self._new_connection()
+                try:
+                    conn.request(method, path, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                    content = response.read()
+                except (http.client.HTTPException, OSError):
+                    conn.close()
+                    raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._put_connection(conn)
+        finally:
+            self._release()
+
+        return response, content
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+def set_host_limit(url, limit):
+    """Set the maximum number of concurrent connections to the host of url."""
+    host = urllib.parse.urlsplit(url).netloc
+
+    with _pools_lock:
+        _host_limits[host] = limit
+        # pools are created with the limit in place at the time, connections
+        # already open are discarded.
+        for key in [key for key in _pools if key[1] == host]:
+            _pools.pop(key).close()
+
+
+def get_pool(url):
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(parts.scheme,
+                                         parts.netloc,
+                                         _host_limits.get(parts.netloc,
+                                                          HOST_LIMIT))
+
+        return _pools[key]
+
+
+def post(url, params):
+    """POST the form-encoded params to url.
+
+    Returns (body, headers) of the response.
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = '{}?{}'.format(path, parts.query)
+
+    body = urllib.parse.urlencode(params).encode('ascii')
+    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Accept-Encoding': 'gzip',
+               'User-Agent': USER_AGENT
+               }
+
+    start = time.perf_counter()
+    response, content = get_pool(url).request('POST', path, body, headers)
+    metrics.observe('request_latency_seconds', parts.netloc,
+                    time.perf_counter() - start)
+    metrics.inc('requests')
+    metrics.inc('bytes_downloaded', len(content))
+
+    if response.status >= 400:
+        raise HTTPError(response.status, response.reason, response.headers)
+
+    if response.getheader('Content-Encoding', '').lower() == 'gzip':
+        content = gzip.decompress(content)
+
+    return content, response.headers
+
+
+def api_request(api_url, params):
+    """Send a request to the API at api_url, return the decoded JSON.
+
+    Raises APIError if the response is an error of the API, with the time to
+    wait from its Retry-After header (MAXLAG for maxlag errors without it).
+    """
+    content, headers = post(api_url, params)
+    data = json.loads(content.decode('utf-8'))
+
+    error = data.get('error') if isinstance(data, dict) else None
+    if error:
+        code = error.get('code')
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        if retry_after is None and code == 'maxlag':
+            retry_after = MAXLAG
+        raise APIError(code, error.get('info'), retry_after)
+
+    return data
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait from a Retry-After header, or None."""
+    if not value:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0, date.timestamp() - time.time())
+
+
+def backoff(attempt, wait_time=WAIT_TIME, max_wait_time=MAX_WAIT_TIME):
+    """Time to wait before the retry no. attempt (from 0), with jitter."""
+    wait = min(max_wait_time, wait_time * 2 ** attempt)
+    return wait / 2 + random.uniform(0, wait / 2)
+
+
+def api_request_retry(api_url,
+                      params,
+                      max_retries=MAX_RETRIES,
+                      wait_time=WAIT_TIME,
+                      maxlag=MAXLAG):
+    """Like api_request(), retrying failed requests up to max_retries times.
+
+    Requests are sent with maxlag (unless None). Throttled requests (HTTP 429
+    and 503, maxlag and ratelimited errors) are retried after the time asked
+    by the server, the other failed requests after backoff(); throttling and
+    server errors also reduce the concurrency towards the host. Errors of the
+    API that are not transient (see APIError.transient) and the HTTP client
+    errors (4xx statuses other than 429) are not retried.
+
+    Raises RequestFailed if all the attempts fail.
+    """
+    if maxlag is not None and 'maxlag' not in params:
+        params = dict(params, maxlag=maxlag)
+
+    pool = get_pool(api_url)
+
+    error = None
+    with metrics.timer('fetch'):
+        for attempt in range(max_retries):
+            if attempt:
+                metrics.inc('retries')
+
+            try:
+                data = api_request(api_url, params)
+            except APIError as err:
+                error = err
+                if not err.transient:
+                    metrics.inc('failed_requests')
+                    raise RequestFailed(api_url, params, attempt + 1, err)
+
+                retry_after = err.retry_after
+                if err.throttled:
+                    metrics.inc('throttled')
+                    pool.throttle(retry_after or 0)
+                else:
+                    pool.throttle()
+                wait = max(retry_after or 0,
+                           backoff(attempt, wait_time))
+            except HTTPError as err:
+                error = err
+                retry_after = parse_retry_after(
+                    err.headers.get('Retry-After'))
+
+                if err.status in THROTTLE_STATUSES:
+                    metrics.inc('throttled')
+                    pool.throttle(retry_after or 0)
+                elif err.status >= 500:
+                    pool.throttle()
+                else:
+                    metrics.inc('failed_requests')
+                    raise RequestFailed(api_url, params, attempt + 1, err)
+                wait = max(retry_after or 0,
+                           backoff(attempt, wait_time))
+            except (IOError, http.client.HTTPException) as err:
+                error = err
+                pool.throttle()
+                wait = backoff(attempt, wait_time)
+            except ValueError as err:
+                error = err
+                wait = backoff(attempt, wait_time)
+            else:
+                pool.success()
+                return data
+
+            if attempt + 1 < max_retries:
+                logger.debug("Request to {} failed: {}, retrying in {:.1f} s"
+                             .format(api_url, error, wait))
+                time.sleep(wait)
+
+    metrics.inc('failed_requests')
+    raise RequestFailed(api_url, params, max_retries, error)
+
+
+def iter_query(api_url, params, max_retries=MAX_RETRIES):
+    """Yield the responses to a query, following its continuation.
+
+    Every request is sent with api_request_retry().
+    """
+    request_params = dict(params)
+    while True:
+        data = api_request_retry(api_url,
+                                 request_params,
+                                 max_retries=max_retries)
+        yield data
+
+        if 'continue' not in data:
+            break
+        request_params = dict(params)
+        request_params.update(data['continue'])